@@ -1,29 +1,902 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
-from pygments import highlight
-from pygments.lexers import JsonLexer
-from pygments.formatters import TerminalFormatter
+import copy
+import re
+import time
+import random
+import threading
+import sqlite3
+import zlib
+from fnmatch import fnmatchcase
+from email.utils import parsedate_to_datetime
+from datetime import datetime
+import math
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from types import MethodType
+from urllib.parse import urlsplit
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-class HttpMethod:
+class DeadlineExceeded(Exception):
 
     """
-    HttpMethod will have methods to send
-    GET, POST, PATCH, PUT, DELETE request to the initalized url
+    Raised when a request can't be sent or answered before the deadline
+    """
+
+class PageResult(list):
+
+    """
+    Records returned by HttpMethod.GetAll,
+    complete is False when the deadline stopped it before the last page
+    """
+
+    complete = True
+
+class RateLimiter:
+
+    """
+    Token bucket shared by every request sent by a FtApi instance.
+    Enforces the secondly and the hourly limit of the application
+    and calibrates itself from the X-*-RateLimit-* response headers.
+    The state (per_second, per_hour, tokens, hourly_remaining, window_end, updated)
+    is read and written inside Shared(): a backend sharing it between processes
+    or hosts (see FileRateLimiter) only has to override Shared().
+    """
+
+    FIELDS = ("per_second", "per_hour", "tokens", "hourly_remaining", "window_end", "updated")
+
+    def __init__(self, per_second=2, per_hour=1200):
+        self.per_second = per_second
+        self.per_hour = per_hour
+        self.tokens = float(per_second)
+        self.hourly_remaining = per_hour
+        self.window_end = self.NextHour()
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def Shared(self):
+        """
+        load the state, let the caller change it, save it (here the state is the instance)
+        """
+        with self.lock:
+            yield
+
+    @staticmethod
+    def NextHour():
+        return (int(time.time()) // 3600 + 1) * 3600
+
+    def Reserve(self):
+        """
+        Take one token and return how many seconds the caller
+        has to wait before sending its request.
+        Once the hour is spent, the bucket only refills from the next one
+        (updated is moved there), so the requests waiting for it keep their
+        per second spacing and are charged to it.
+        """
+        with self.Shared():
+            now = time.time()
+            if now >= self.window_end:
+                self.window_end = self.NextHour()
+                # the requests which overdrew the last hour belong to this one
+                self.hourly_remaining = self.per_hour + min(0, self.hourly_remaining)
+            self.tokens = min(float(self.per_second), self.tokens + max(0.0, now - self.updated) * self.per_second)
+            self.updated = max(now, self.updated)
+            self.hourly_remaining -= 1
+            if self.hourly_remaining < 0:
+                start = self.window_end + (-self.hourly_remaining - 1) // self.per_hour * 3600
+                if self.updated < start:
+                    # the bucket keeps refilling until that hour starts
+                    self.tokens = min(float(self.per_second), self.tokens + (start - self.updated) * self.per_second)
+                    self.updated = start
+            self.tokens -= 1
+            wait = self.updated - now
+            if self.tokens < 0:
+                wait += -self.tokens / self.per_second
+            return wait
+
+    def Remaining(self):
+        """
+        return the requests left in the current hour
+        """
+        with self.Shared():
+            return self.per_hour if time.time() >= self.window_end else self.hourly_remaining
+
+    def Budget(self):
+        """
+        return the limits and what is left of them, as last seen in the rate limit headers
+        """
+        with self.Shared():
+            now = time.time()
+            reset = now >= self.window_end
+            return {
+                'per_second': self.per_second,
+                'per_hour': self.per_hour,
+                'hourly_remaining': self.per_hour if reset else self.hourly_remaining,
+                'reset_in': (self.NextHour() if reset else self.window_end) - now,
+                'tokens': min(float(self.per_second), self.tokens + max(0.0, now - self.updated) * self.per_second),
+            }
+
+    def Wait(self):
+        """
+        return how many seconds a request would wait now, without taking a token
+        """
+        with self.Shared():
+            tokens = min(float(self.per_second), self.tokens + max(0.0, time.time() - self.updated) * self.per_second)
+            wait = max(0.0, self.updated - time.time()) + ((1 - tokens) / self.per_second if tokens < 1 else 0.0)
+            if time.time() < self.window_end and self.hourly_remaining < 1:
+                wait = max(wait, self.window_end - time.time())
+            return wait
+
+    def Acquire(self):
+        """
+        Block until a request can be sent
+        """
+        wait = self.Reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def Update(self, headers):
+        """
+        Calibrate the limits with the rate limit headers of a response
+        """
+        with self.Shared():
+            if "X-Secondly-RateLimit-Limit" in headers:
+                self.per_second = max(1, int(headers["X-Secondly-RateLimit-Limit"]))
+            if "X-Hourly-RateLimit-Limit" in headers:
+                self.per_hour = int(headers["X-Hourly-RateLimit-Limit"])
+            if "X-Hourly-RateLimit-Remaining" in headers:
+                self.hourly_remaining = int(headers["X-Hourly-RateLimit-Remaining"])
+
+class Scheduler:
+
+    """
+    Priority lanes in front of the RateLimiter: the requests wait in their lane
+    (interactive, normal, background) and only one at a time, picked by weighted
+    round robin between the lanes which have requests, waits for the limiter.
+    An interactive request passes the thousands of queued background ones
+    while every lane still gets its share of the quota.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = dict(weights) if weights is not None else {"interactive": 16, "normal": 4, "background": 1}
+        self.lanes = {lane: deque() for lane in self.weights}
+        self.current = {lane: 0 for lane in self.weights}
+        self.turn = None
+        self.condition = threading.Condition()
+
+    def Dispatch(self):
+        """
+        give the turn to the next request (smooth weighted round robin), the condition is held
+        """
+        if self.turn is not None:
+            return
+        active = [lane for lane in self.lanes if self.lanes[lane]]
+        if not active:
+            return
+        for lane in active:
+            self.current[lane] += self.weights[lane]
+        lane = max(active, key=lambda lane: self.current[lane])
+        self.current[lane] -= sum(self.weights[lane] for lane in active)
+        self.turn = self.lanes[lane].popleft()
+        self.condition.notify_all()
+
+    @contextmanager
+    def Turn(self, priority=None, end=None):
+        """
+        wait in the lane of priority until it is the turn of the request,
+        the next one gets its turn when the block is left
+        """
+        lane = priority if priority is not None else "normal"
+        if lane not in self.lanes:
+            raise Exception(f"unknown priority {lane}, use one of {', '.join(self.lanes)}")
+        ticket = object()
+        with self.condition:
+            self.lanes[lane].append(ticket)
+            self.Dispatch()
+            while self.turn is not ticket:
+                remaining = end - time.monotonic() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    self.lanes[lane].remove(ticket)
+                    raise DeadlineExceeded("deadline passed while waiting for the rate limit")
+                self.condition.wait(remaining)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.turn = None
+                self.Dispatch()
+
+    def Acquire(self, limiter, priority=None, end=None):
+        """
+        wait for the turn of the request then for a token of limiter
+        return the seconds the caller still has to wait (like RateLimiter.Reserve)
+        """
+        with self.Turn(priority, end):
+            FtSession.Sleep(limiter.Wait(), end)
+            return limiter.Reserve()
+
+class ConcurrencyController:
+
+    """
+    Number of requests in flight adjusted like TCP (AIMD): it grows by increase
+    every round of successful requests and is multiplied by decrease on a 429,
+    a 5xx, a connection error or when the p95 latency of the last window requests
+    goes over factor times its usual value. At most one cut per round.
+    Used by the parallel crawls: ftApi.Users().GetAll(workers="auto")
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=32, increase=1, decrease=0.5, window=20, factor=2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.factor = factor
+        self.latencies = deque(maxlen=window)
+        self.baseline = None
+        self.p95 = None
+        self.inflight = 0
+        self.since_cut = 0
+        self.condition = threading.Condition()
+
+    def Acquire(self, end=None):
+        """
+        wait until fewer than limit requests are in flight
+        """
+        with self.condition:
+            while self.inflight >= int(self.limit):
+                remaining = end - time.monotonic() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceeded("deadline passed while waiting for a request slot")
+                self.condition.wait(remaining)
+            self.inflight += 1
+
+    def Release(self):
+        with self.condition:
+            self.inflight -= 1
+            self.condition.notify_all()
+
+    def Observe(self, latency, status=None):
+        """
+        latency of one attempt, status is None when the connection failed
+        """
+        with self.condition:
+            self.since_cut += 1
+            self.latencies.append(latency)
+            if len(self.latencies) == self.latencies.maxlen:
+                self.p95 = sorted(self.latencies)[int(len(self.latencies) * 0.95) - 1]
+                # the usual latency follows slowly the one of the day
+                self.baseline = self.p95 if self.baseline is None else min(self.p95, self.baseline + (self.p95 - self.baseline) * 0.05)
+            congested = status is None or status == 429 or status >= 500 \
+                    or (self.p95 is not None and self.p95 > self.baseline * self.factor)
+            if congested:
+                if self.since_cut >= self.limit:
+                    self.limit = max(float(self.minimum), self.limit * self.decrease)
+                    self.since_cut = 0
+            else:
+                self.limit = min(float(self.maximum), self.limit + self.increase / self.limit)
+            self.condition.notify_all()
+
+class RetryPolicy:
+
+    """
+    Decide if a failed request has to be sent again and how long to wait.
+    Idempotent methods are retried on the given status codes, on connection
+    errors, resets and timeouts, 429 is always retried because the request was not processed.
+    """
+
+    def __init__(self, retries=5, backoff=0.5, max_backoff=60, statuses=(429, 502, 503, 504),
+            idempotent=("GET", "HEAD", "OPTIONS", "PUT", "DELETE")):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.idempotent = frozenset(idempotent)
+
+    def ShouldRetry(self, method, attempt, status=None):
+        """
+        status is None when the connection failed, was reset or timed out
+        """
+        if attempt >= self.retries:
+            return False
+        if status is not None and status not in self.statuses:
+            return False
+        return status == 429 or method.upper() in self.idempotent
+
+    def Backoff(self, attempt, retry_after=None):
+        """
+        return the seconds to wait: Retry-After if the server sent one,
+        otherwise an exponential backoff with full jitter so parallel
+        workers don't retry at the same time
+        """
+        delay = None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+        if delay is not None:
+            return max(0.0, delay) + random.uniform(0, self.backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+class FtSession(requests.Session):
+
+    """
+    requests.Session used by FtApi, every request waits for the rate limiter
+    and is sent again according to the retry policy.
+    authorize() is called before each request so the bearer is asked lazily.
+    On 401, refresh(sent_authorization) is called once and the request replayed.
+    timeout is used by the requests which don't give their own.
+    end (time.monotonic()) caps the timeout of the request and every wait:
+    DeadlineExceeded is raised instead of going past it.
+    reserved: wait already taken from the limiter by the caller (see PoolSession),
+    the first attempt doesn't Reserve again.
+    priority: lane of the scheduler (interactive, normal, background) the request waits in
+    controller: ConcurrencyController giving a slot to the request and told the latency
+    and status of every attempt
+    """
+
+    def __init__(self, limiter=None, retry=None, refresh=None, authorize=None, cache=None, timeout=None, scheduler=None):
+        super().__init__()
+        self.limiter = limiter
+        self.scheduler = scheduler
+        self.retry = retry
+        self.refresh = refresh
+        self.authorize = authorize
+        self.cache = cache
+        self.timeout = timeout
+
+    @staticmethod
+    def Sleep(seconds, end=None):
+        if end is not None and time.monotonic() + seconds > end:
+            raise DeadlineExceeded(f"waiting {seconds:.1f}s would pass the deadline" if seconds > 0 else "deadline passed")
+        if seconds > 0:
+            time.sleep(seconds)
+
+    @staticmethod
+    def Remaining(timeout, end):
+        """
+        return timeout capped to the time left before end
+        """
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("deadline passed")
+        if timeout is None:
+            return remaining
+        if isinstance(timeout, tuple):
+            return tuple(min(value, remaining) if value is not None else remaining for value in timeout)
+        return min(timeout, remaining)
+
+    def Budget(self):
+        return self.limiter.Budget() if self.limiter is not None else None
+
+    def Reserve(self, priority=None, end=None):
+        if self.scheduler is not None:
+            return self.scheduler.Acquire(self.limiter, priority, end)
+        return self.limiter.Reserve()
+
+    def request(self, method, url, *args, controller=None, **kwargs):
+        if controller is None:
+            return self.Send(method, url, *args, **kwargs)
+        controller.Acquire(kwargs.get('end'))
+        try:
+            return self.Send(method, url, *args, controller=controller, **kwargs)
+        finally:
+            controller.Release()
+
+    def Send(self, method, url, *args, end=None, reserved=None, priority=None, controller=None, **kwargs):
+        timeout = kwargs.pop('timeout', self.timeout)
+        attempt = 0
+        refreshed = False
+        while True:
+            if self.authorize is not None:
+                self.authorize()
+            if self.limiter is not None:
+                self.Sleep(reserved if reserved is not None else self.Reserve(priority, end), end)
+                reserved = None
+            kwargs['timeout'] = self.Remaining(timeout, end) if end is not None else timeout
+            sent = self.headers.get('Authorization')
+            started = time.monotonic()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                # refused, reset (while sending or reading the body) or timed out:
+                # only the idempotent methods are sent again
+                if controller is not None:
+                    controller.Observe(time.monotonic() - started)
+                if end is not None and time.monotonic() >= end:
+                    raise DeadlineExceeded(f"{method} {url} didn't finish before the deadline") from e
+                if self.retry is None or not self.retry.ShouldRetry(method, attempt):
+                    raise
+                self.Sleep(self.retry.Backoff(attempt), end)
+                attempt += 1
+                continue
+            if controller is not None:
+                controller.Observe(time.monotonic() - started, response.status_code)
+            if self.limiter is not None:
+                self.limiter.Update(response.headers)
+            if response.status_code == 401 and self.refresh is not None and not refreshed:
+                refreshed = True
+                self.refresh(sent)
+                continue
+            if self.retry is None or not self.retry.ShouldRetry(method, attempt, response.status_code):
+                return response
+            self.Sleep(self.retry.Backoff(attempt, response.headers.get("Retry-After")), end)
+            attempt += 1
+
+class JsonFile:
+
+    """
+    json file shared by threads and processes: FileLock() serializes the
+    read-modify-write cycles and Save() replaces the file atomically
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def FileLock(self):
+        with self.lock, open(self.path + ".lock", 'a') as lockfile:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def Load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def Save(self, content):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(content, f)
+        os.replace(tmp, self.path)
+
+class TokenStore(JsonFile):
+
+    """
+    Keep the OAuth tokens in a json file shared by every process,
+    keyed by uid + scope. A token is reused until it is about to expire
+    (margin seconds before expires_at), the file is locked meanwhile
+    so only one process asks /oauth/token for a new one.
+    """
+
+    def __init__(self, path=None, margin=60):
+        super().__init__(path if path is not None else os.path.join(os.path.expanduser("~"), ".ftapi_tokens.json"))
+        self.margin = margin
+
+    @staticmethod
+    def Key(uid, scope):
+        return f"{uid}:{scope}"
+
+    def IsValid(self, token):
+        return token.get('expires_at', 0) - self.margin > time.time()
+
+    def Fetch(self, uid, scope, request, stale=None):
+        """
+        return the cached token for uid + scope, or call request()
+        to get a new one and store it (also when the cached one is stale)
+        """
+        key = self.Key(uid, scope)
+        with self.FileLock():
+            tokens = self.Load()
+            token = tokens.get(key)
+            if token is None or not self.IsValid(token) or token['access_token'] == stale:
+                token = request()
+                tokens = {k: v for k, v in tokens.items() if self.IsValid(v)}
+                tokens[key] = token
+                self.Save(tokens)
+            return token
+
+class FileRateLimiter(RateLimiter):
+
+    """
+    RateLimiter whose bucket is kept in a locked json file, so every process
+    of the host using the same application (workers, cron jobs...) takes its
+    tokens from the same bucket. The waits are given in the order the tokens
+    are reserved, each process gets its share and the host stays under the limit.
+    name: one bucket per application, FtApi(uid, secret, limiter=FileRateLimiter(name=uid))
+    """
+
+    def __init__(self, path=None, name="default", per_second=2, per_hour=1200):
+        super().__init__(per_second, per_hour)
+        self.file = JsonFile(path if path is not None else os.path.join(os.path.expanduser("~"), ".ftapi_ratelimit.json"))
+        self.name = name
+
+    @contextmanager
+    def Shared(self):
+        with self.file.FileLock():
+            buckets = self.file.Load()
+            for field, value in buckets.get(self.name, {}).items():
+                if field in self.FIELDS:
+                    setattr(self, field, value)
+            yield
+            buckets[self.name] = {field: getattr(self, field) for field in self.FIELDS}
+            self.file.Save(buckets)
+
+class MarkStore(JsonFile):
+
+    """
+    High-water marks of HttpMethod.Sync in a json file, keyed by url + filter
+    """
+
+    def __init__(self, path=None):
+        super().__init__(path if path is not None else os.path.join(os.path.expanduser("~"), ".ftapi_marks.json"))
+
+    def Get(self, key):
+        with self.FileLock():
+            return self.Load().get(key)
+
+    def Set(self, key, mark):
+        with self.FileLock():
+            marks = self.Load()
+            marks[key] = mark
+            self.Save(marks)
+
+class CacheEntry:
+
+    """
+    Parsed json of a GET response with the headers needed
+    to revalidate it and to paginate (X-Total, Link...)
+    """
+
+    KEPT_HEADERS = ("ETag", "Last-Modified", "X-Total", "X-Per-Page", "X-Page", "Link")
+
+    def __init__(self, status_code, data, headers, stored_at=None, size=0):
+        self.status_code = status_code
+        self.data = data
+        self.headers = {name: headers[name] for name in self.KEPT_HEADERS if name in headers}
+        self.stored_at = stored_at if stored_at is not None else time.time()
+        self.size = size
+
+    def Validators(self):
+        """
+        return the conditional headers to revalidate the entry
+        """
+        headers = {}
+        if "ETag" in self.headers:
+            headers["If-None-Match"] = self.headers["ETag"]
+        if "Last-Modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["Last-Modified"]
+        return headers
+
+class CacheRule:
+
+    """
+    Cache options of the endpoints whose path matches pattern (fnmatch syntax):
+    CacheRule("/v2/cursus*", ttl=86400), CacheRule("/v2/campus/*/locations", ttl=30)
+    ttl: seconds during which the entry is returned without any request
+    stale: seconds after the ttl during which the old entry is still returned
+    right away while a background thread requests it again
+    negative_ttl: seconds during which a 404 is kept and raised without any request
+    invalidates: patterns of the cached urls (query string included) to forget
+    when an endpoint matching the rule is modified, e.g.
+    CacheRule("/v2/scale_teams/*", invalidates=["/v2/teams/*"])
+    """
+
+    def __init__(self, pattern, ttl=0, stale=0, negative_ttl=0, invalidates=()):
+        self.pattern = pattern
+        self.ttl = ttl
+        self.stale = stale
+        self.negative_ttl = negative_ttl
+        self.invalidates = list(invalidates)
+
+    def Match(self, path):
+        return fnmatchcase(path, self.pattern)
+
+class MemoryStore:
+
+    """
+    CacheEntry storage of the process, the least recently used entries
+    are evicted past max_entries entries or max_bytes of response bodies
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def Get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def Set(self, key, entry):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def Delete(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+
+    def DeleteMatching(self, pattern):
+        with self.lock:
+            for key in [key for key in self.entries if fnmatchcase(key, pattern)]:
+                self.size -= self.entries.pop(key).size
+
+class SqliteStore:
+
+    """
+    CacheEntry storage in a sqlite file, so restarted processes start warm.
+    The json is compressed with zlib and the least recently used entries
+    are evicted when the payloads exceed max_bytes.
+    """
+
+    def __init__(self, path=None, max_bytes=64 * 1024 * 1024):
+        self.path = path if path is not None else os.path.join(os.path.expanduser("~"), ".ftapi_cache.sqlite")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, status INTEGER, "
+                "headers TEXT, payload BLOB, size INTEGER, stored_at REAL, used_at REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_used_at ON entries (used_at)")
+
+    def Get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT status, headers, payload, stored_at FROM entries WHERE key = ?",
+                    (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE entries SET used_at = ? WHERE key = ?", (time.time(), key))
+        status, headers, payload, stored_at = row
+        return CacheEntry(status, json.loads(zlib.decompress(payload)), json.loads(headers), stored_at, len(payload))
+
+    def Set(self, key, entry):
+        payload = zlib.compress(json.dumps(entry.data).encode('utf-8'))
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, entry.status_code, json.dumps(entry.headers), payload, len(payload), entry.stored_at, time.time()))
+            self.Evict()
+
+    def Delete(self, key):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def DeleteMatching(self, pattern):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries WHERE key GLOB ?", (pattern,))
+
+    def Evict(self):
+        """
+        Delete the least recently used entries until the payloads fit in max_bytes
+        """
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM entries ORDER BY used_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+class ResponseCache:
+
+    """
+    HTTP cache of FtApi (FtApi(cache=ResponseCache())).
+    GET responses are kept per url, query string included, in store
+    (MemoryStore by default, SqliteStore to survive restarts).
+    An entry younger than the ttl of its CacheRule is returned without any request,
+    otherwise it is requested again with If-None-Match / If-Modified-Since:
+    on 304 the json already parsed is returned (share it, don't modify it).
+    Concurrent GETs of the same url wait for a single request (coalesce=True).
+    Stale entries and 404 can also be served, see CacheRule. Stats() counts
+    hits, stale and negative answers, misses and revalidated (304) responses.
+    """
+
+    def __init__(self, store=None, rules=(), ttl=0, coalesce=True):
+        self.store = store if store is not None else MemoryStore()
+        self.rules = list(rules)
+        self.default = CacheRule("*", ttl)
+        self.coalesce = coalesce
+        self.inflight = {}
+        self.executor = None
+        self.stats = {"hits": 0, "stale": 0, "negative": 0, "misses": 0, "revalidated": 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def Key(url):
+        parts = urlsplit(url)
+        return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+    @staticmethod
+    def Escape(path):
+        """
+        match path literally in a fnmatch / GLOB pattern
+        """
+        return re.sub(r"([*?[])", r"[\1]", path)
+
+    def Rule(self, key):
+        """
+        return the first CacheRule matching the path of key
+        """
+        path = key.split("?", 1)[0]
+        for rule in self.rules:
+            if rule.Match(path):
+                return rule
+        return self.default
+
+    def Fetch(self, session, url, **options):
+        """
+        return (json, response Object or CacheEntry) like HttpMethod.Fetch
+        options are given to session.get (timeout, end)
+        """
+        key = self.Key(url)
+        rule = self.Rule(key)
+        entry = self.store.Get(key)
+        if entry is not None:
+            age = time.time() - entry.stored_at
+            if entry.status_code == 404:
+                if age < rule.negative_ttl:
+                    self.Count("negative")
+                    raise requests.HTTPError(f"404 Client Error: Not Found (cached) for url: {url}")
+                entry = None
+            elif age < rule.ttl:
+                self.Count("hits")
+                return entry.data, entry
+            elif age < rule.ttl + rule.stale:
+                self.Count("stale")
+                self.Revalidate(session, url, key, rule, entry, options)
+                return entry.data, entry
+        self.Count("misses")
+        return self.Coalesce(session, url, key, rule, entry, options)
+
+    def Count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def Stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def Revalidate(self, session, url, key, rule, entry, options):
+        """
+        Request the stale entry again on a background thread
+        (unless it is already being requested), the caller's deadline doesn't apply
+        """
+        options = {name: value for name, value in options.items() if name != 'end'}
+        with self.lock:
+            if key in self.inflight:
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=2)
+        self.executor.submit(self.Coalesce, session, url, key, rule, entry, options)
+
+    def Coalesce(self, session, url, key, rule, entry, options):
+        """
+        Send the request, or wait for the identical one already sent
+        """
+        if not self.coalesce:
+            return self.Request(session, url, key, rule, entry, options)
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Future()
+        if not leader:
+            return flight.result()
+        try:
+            result = self.Request(session, url, key, rule, entry, options)
+            flight.set_result(result)
+            return result
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def Invalidate(self, url):
+        """
+        Forget the entries made stale by a modification of url: the resource
+        (every query string and sub resource), the listings of its parent
+        collections and the invalidates patterns of the matching CacheRules
+        """
+        path = urlsplit(url).path.rstrip("/")
+        literal = self.Escape(path)
+        patterns = [literal, literal + "[?]*", literal + "/*"]
+        parent = path
+        while parent.count("/") > 2:
+            parent = parent.rsplit("/", 1)[0]
+            patterns += [self.Escape(parent), self.Escape(parent) + "[?]*"]
+        for rule in self.rules:
+            if rule.Match(path):
+                patterns += rule.invalidates
+        for pattern in patterns:
+            self.store.DeleteMatching(pattern)
+
+    def Request(self, session, url, key, rule, entry, options):
+        """
+        Send the GET (conditional if entry has validators) and store the result
+        """
+        response = session.get(url, headers=entry.Validators() if entry is not None else None, **options)
+        if response.status_code == 304 and entry is not None:
+            self.Count("revalidated")
+            entry.stored_at = time.time()
+            self.store.Set(key, entry)
+            return entry.data, entry
+        if response.status_code == 404 and rule.negative_ttl > 0:
+            self.store.Set(key, CacheEntry(404, None, response.headers, size=len(response.content)))
+        response.raise_for_status()
+        data = json.loads(response.text)
+        if rule.ttl > 0 or "ETag" in response.headers or "Last-Modified" in response.headers:
+            self.store.Set(key, CacheEntry(response.status_code, data, response.headers, size=len(response.content)))
+        return data, response
+
+class BaseHttpMethod:
+
+    """
+    url, query parameters and page bookkeeping shared by HttpMethod and AsyncHttpMethod
     """
 
     def __init__(self, extension, session, **kwargs):
         self.url = "https://api.intra.42.fr{}".format(extension)
-        self.filter = kwargs["filter"] if "filter" in kwargs else {}
-        self.page = kwargs["pages"] if "pages" in kwargs else {'size':100, 'number':1}
+        self.filter = dict(kwargs["filter"]) if "filter" in kwargs else {}
+        self.page = dict(kwargs["pages"]) if "pages" in kwargs else {'size':100, 'number':1}
         self.sort = kwargs["sort"] if "sort" in kwargs else ""
-        self.range = kwargs["range"] if "range" in kwargs else {}
+        self.range = dict(kwargs["range"]) if "range" in kwargs else {}
+        self.methods = kwargs["methods"] if "methods" in kwargs else None
+        self.timeout = kwargs["timeout"] if "timeout" in kwargs else None
         self.session = session
+        self.lock = threading.Lock()
 
-    def ParseParams(self):
+    def Copy(self, **kwargs):
+        """
+        return a HttpMethod on the same url with some of filter, pages, sort, range changed
+        """
+        method = copy.copy(self)
+        method.filter = dict(kwargs["filter"] if "filter" in kwargs else self.filter)
+        method.page = dict(kwargs["pages"] if "pages" in kwargs else self.page)
+        method.sort = kwargs["sort"] if "sort" in kwargs else self.sort
+        method.range = dict(kwargs["range"] if "range" in kwargs else self.range)
+        method.lock = threading.Lock()
+        return method
+
+    def Allow(self, method):
+        """
+        Refuse the http methods the endpoint doesn't have (when it is known)
+        """
+        if self.methods is not None and method not in self.methods:
+            raise Exception(f"{method} is not available on {self.url}")
+
+    def ParseParams(self, number=None):
 
+        page = dict(self.page, number=number) if self.page and number is not None else self.page
         filter_query = "&".join([f"filter[{key}]={value}" for key, value in self.filter.items()]) if self.filter else ""
-        page_query = "&".join([f"page[{key}]={value}" for key, value in self.page.items()]) if self.page else ""
+        page_query = "&".join([f"page[{key}]={value}" for key, value in page.items()]) if page else ""
         range_query = "&".join([f"range[{key}]={value}" for key, value in self.range.items()]) if self.range else ""
 
         result = "&".join([query for query in [filter_query, page_query, range_query] if query != ""])
@@ -35,21 +908,386 @@ class HttpMethod:
                 result = f"sort={self.sort}"
 
         return f"?{result}" if result else ""
- 
-    def Get(self):
+
+    def IsLastPage(self, data, response, number):
+        """
+        Use X-Total / X-Per-Page (or the Link header) to know if
+        the page is the last one, so no extra empty page is requested
+        """
+        if not isinstance(data, list) or not data:
+            return True
+        last = self.LastPageNumber(response)
+        if last is not None:
+            return number >= last
+        link = response.headers.get("Link")
+        if link is not None:
+            return 'rel="next"' not in link
+        return len(data) < int(self.page.get('size', 30))
+
+    def LastPageNumber(self, response):
+        """
+        return the last page number from X-Total / X-Per-Page, None if unknown
+        """
+        total = response.headers.get("X-Total")
+        per_page = response.headers.get("X-Per-Page")
+        if total is None or not per_page or int(per_page) <= 0:
+            return None
+        return max(1, -(-int(total) // int(per_page)))
+
+    def NextPage(self):
+        """
+        return the current page number and move to the next one,
+        concurrent calls get different pages
+        """
+        with self.lock:
+            number = self.page['number']
+            self.page['number'] += 1
+            return number
+
+    def PageFailed(self, number):
         """
-        return json
+        go back to the page which failed, unless other pages were taken since
         """
-        response = self.session.get(self.url + self.ParseParams())
+        with self.lock:
+            if self.page['number'] == number + 1:
+                self.page['number'] = number
+
+class HttpMethod(BaseHttpMethod):
+
+    """
+    HttpMethod will have methods to send
+    GET, POST, PATCH, PUT, DELETE request to the initalized url
+    """
+
+    def __init__(self, extension, session, **kwargs):
+        super().__init__(extension, session, **kwargs)
+        self.priority = kwargs["priority"] if "priority" in kwargs else None
+        self.controller = kwargs["controller"] if "controller" in kwargs else None
+
+    def Options(self, end=None):
+        """
+        return the timeout, the priority and the ConcurrencyController of this HttpMethod
+        and the deadline (time.monotonic()) to give to the session, when they are set
+        """
+        options = {}
+        if self.timeout is not None:
+            options['timeout'] = self.timeout
+        if self.priority is not None:
+            options['priority'] = self.priority
+        if self.controller is not None:
+            options['controller'] = self.controller
+        if end is not None:
+            options['end'] = end
+        return options
+
+    def Fetch(self, number=None, end=None):
+        """
+        return (json, response Object) for the given page number
+        without touching self.page
+        """
+        self.Allow("GET")
+        url = self.url + self.ParseParams(number)
+        cache = getattr(self.session, "cache", None)
+        if cache is not None:
+            return cache.Fetch(self.session, url, **self.Options(end))
+        response = self.session.get(url, **self.Options(end))
         response.raise_for_status()
-        if self.page and "number" in self.page: self.page['number'] += 1
-        return json.loads(response.text)
+        return json.loads(response.text), response
+
+    def Get(self):
+        """
+        return json of the current page and move to the next one
+        (an HttpMethod can be shared by several threads)
+        """
+        if not self.page or "number" not in self.page:
+            return self.Fetch()[0]
+        number = self.NextPage()
+        try:
+            return self.Fetch(number)[0]
+        except Exception:
+            self.PageFailed(number)
+            raise
+
+    def KeysetPages(self, key, end=None):
+        """
+        yield each page sorted by key (an integer column such as id), the next
+        page is asked with range[key]=last+1,max instead of a page number:
+        deep pages stay cheap and rows inserted meanwhile don't shift them
+        """
+        low, high = 0, 2 ** 31 - 1
+        if key in self.range:
+            low, high = (int(value) for value in str(self.range[key]).split(","))
+        size = self.page.get('size', 100) if self.page else 100
+        while low <= high:
+            method = self.Copy(range=dict(self.range, **{key: f"{low},{high}"}), sort=key, pages={'size': size, 'number': 1})
+            data, response = method.Fetch(end=end)
+            if not isinstance(data, list):
+                yield data
+                return
+            if data:
+                yield data
+            if method.IsLastPage(data, response, 1):
+                return
+            low = max(int(record[key]) for record in data) + 1
+
+    def IterPages(self, prefetch=False, deadline=None, keyset=None):
+        """
+        yield each page (json) from the current page number until the last one
+        prefetch=True fetches the next page on a background thread
+        while the current one is being processed
+        deadline: seconds, DeadlineExceeded is raised when they are over
+        (the pages already yielded are still valid)
+        keyset="id": paginate with range[id] instead of page numbers (see KeysetPages)
+        """
+        end = time.monotonic() + deadline if deadline is not None else None
+        if keyset is not None:
+            yield from self.KeysetPages(keyset, end)
+            return
+        if not self.page:
+            yield self.Fetch(end=end)[0]
+            return
+        number = self.page.get('number', 1)
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            data, response = self.Fetch(number, end)
+            while True:
+                last = self.IsLastPage(data, response, number)
+                pending = executor.submit(self.Fetch, number + 1, end) if executor and not last else None
+                if data:
+                    yield data
+                if last:
+                    return
+                number += 1
+                data, response = pending.result() if pending else self.Fetch(number, end)
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def Controlled(self, workers):
+        """
+        return a copy of self whose requests are throttled by the ConcurrencyController
+        workers ("auto" creates one), None if workers is a number
+        """
+        if workers != "auto" and not isinstance(workers, ConcurrencyController):
+            return None
+        method = self.Copy()
+        method.controller = ConcurrencyController() if workers == "auto" else workers
+        return method
+
+    def GetAll(self, workers=1, deadline=None, keyset=None):
+        """
+        return every record of every page in a single PageResult (in page order)
+        with workers > 1, the first page gives X-Total and the remaining
+        pages are fetched concurrently on the shared session
+        workers="auto" (or a ConcurrencyController): as many concurrent requests
+        as the API handles, adjusted from the latencies and the 429 / 5xx
+        deadline: seconds, once over the pages already fetched are returned
+        with PageResult.complete = False
+        keyset="id": paginate with range[id] instead of page numbers (sequential)
+        """
+        method = self.Controlled(workers)
+        if method is not None:
+            return method.GetAll(method.controller.maximum, deadline, keyset)
+        end = time.monotonic() + deadline if deadline is not None else None
+        if keyset is not None:
+            result = PageResult()
+            try:
+                for data in self.KeysetPages(keyset, end):
+                    if not isinstance(data, list):
+                        return data
+                    result.extend(data)
+            except DeadlineExceeded:
+                result.complete = False
+            return result
+        if not self.page:
+            return self.Fetch(end=end)[0]
+        number = self.page.get('number', 1)
+        result = PageResult()
+        try:
+            data, response = self.Fetch(number, end)
+            if not isinstance(data, list):
+                return data
+            result.extend(data)
+            last = self.LastPageNumber(response)
+            if workers > 1 and last is not None:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(self.Fetch, page, end) for page in range(number + 1, last + 1)]
+                    try:
+                        for future in futures:
+                            result.extend(future.result()[0])
+                    finally:
+                        for future in futures:
+                            future.cancel()
+                return result
+            while not self.IsLastPage(data, response, number):
+                number += 1
+                data, response = self.Fetch(number, end)
+                result.extend(data)
+        except DeadlineExceeded:
+            result.complete = False
+        return result
+
+    def Bound(self, key, last=False):
+        """
+        return the key of the first (or last) record sorted by key, None if there is none
+        """
+        data, _ = self.Copy(sort=f"-{key}" if last else key, pages={'size': 1, 'number': 1}).Fetch()
+        return data[0][key] if isinstance(data, list) and data else None
+
+    def Windows(self, shards, key="id", low=None, high=None):
+        """
+        split [low, high] of key in shards windows, return one HttpMethod per window
+        key is an integer column (id: disjoint windows) or a date (created_at: the
+        windows share their bounds, GetSharded drops the duplicates).
+        low / high default to range[key], else to the first / last record
+        """
+        if key in self.range and (low is None or high is None):
+            bounds = str(self.range[key]).split(",")
+            low, high = low if low is not None else bounds[0], high if high is not None else bounds[1]
+        low = low if low is not None else self.Bound(key)
+        high = high if high is not None else self.Bound(key, last=True)
+        if low is None or high is None:
+            return []
+        dates = not str(low).lstrip("-").isdigit()
+        if dates:
+            low = math.floor(datetime.fromisoformat(str(low).replace("Z", "+00:00")).timestamp())
+            high = math.ceil(datetime.fromisoformat(str(high).replace("Z", "+00:00")).timestamp())
+            Format = lambda value: time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(value))
+        else:
+            low, high = int(low), int(high)
+            Format = str
+        shards = max(1, min(shards, high - low + 1))
+        edges = [low + (high - low + (0 if dates else 1)) * i // shards for i in range(shards + 1)]
+        windows = []
+        for start, stop in zip(edges, edges[1:]):
+            stop = stop if dates else stop - 1
+            window = f"{Format(start)},{Format(stop)}"
+            windows.append(self.Copy(range=dict(self.range, **{key: window}), sort=key, pages=dict(self.page or {'size': 100}, number=1)))
+        return windows
+
+    def GetSharded(self, shards=8, key="id", low=None, high=None, workers=None, deadline=None, keyset=None):
+        """
+        crawl a huge collection as shards windows of range[key] (see Windows),
+        each window paginated on its own, the windows concurrently (workers,
+        default one per window), and return the records merged in key order.
+        The page queries stay cheap (no deep OFFSET) and the throughput grows
+        with the workers until the rate limit.
+        deadline / keyset: as GetAll, for each window
+        workers="auto" (or a ConcurrencyController): the windows in flight follow
+        the capacity of the API (shards is then the maximum)
+        """
+        method = self.Controlled(workers)
+        if method is not None:
+            return method.GetSharded(shards, key, low, high, None, deadline, keyset)
+        end = time.monotonic() + deadline if deadline is not None else None
+        windows = self.Windows(shards, key, low, high)
+        result = PageResult()
+        if not windows:
+            return result
+        Crawl = lambda window: window.GetAll(deadline=end - time.monotonic() if end is not None else None, keyset=keyset)
+        seen = set()
+        with ThreadPoolExecutor(max_workers=workers or len(windows)) as executor:
+            futures = [executor.submit(Crawl, window) for window in windows]
+            try:
+                for future in futures:
+                    records = future.result()
+                    result.complete = result.complete and records.complete
+                    for record in records:
+                        if isinstance(record, dict) and "id" in record:
+                            if record["id"] in seen:
+                                continue
+                            seen.add(record["id"])
+                        result.append(record)
+            finally:
+                for future in futures:
+                    future.cancel()
+        return result
+
+    def Estimate(self, workers=1):
+        """
+        tell what crawling every page would cost, before doing it: a page[size]=1
+        request reads X-Total, the wall time comes from the rate limit budget of
+        the session and the latency of that request spread over workers
+        return: {'total', 'pages', 'requests', 'hourly_remaining', 'fits', 'seconds'}
+        """
+        started = time.monotonic()
+        _, response = self.Copy(pages={'size': 1, 'number': 1}).Fetch()
+        latency = time.monotonic() - started
+        total = response.headers.get("X-Total")
+        total = int(total) if total is not None else None
+        # without page[size] the API sends 30 records per page (as IsLastPage assumes)
+        size = int(self.page.get('size', 30)) if self.page else None
+        pages = max(1, -(-total // size)) if total is not None and size else 1
+        seconds = pages * latency / (workers if isinstance(workers, int) else 1)
+        budget = self.session.Budget() if hasattr(self.session, "Budget") else None
+        remaining = budget['hourly_remaining'] if budget is not None else None
+        if budget is not None:
+            if pages <= remaining:
+                limited = max(0.0, pages - budget['tokens']) / budget['per_second']
+            else:
+                # the rest waits for the next hours
+                later = pages - max(0, remaining)
+                hours = (later - 1) // budget['per_hour']
+                limited = budget['reset_in'] + hours * 3600 + (later - hours * budget['per_hour']) / budget['per_second']
+            seconds = max(seconds, limited)
+        return {
+            'total': total,
+            'pages': pages,
+            'requests': pages,
+            'hourly_remaining': remaining,
+            'fits': remaining is None or pages <= remaining,
+            'seconds': seconds,
+        }
+
+    def Sync(self, marks=None, field="updated_at", overlap=0, deadline=None):
+        """
+        yield only the records changed since the last Sync of the same url + filter:
+        the window range[field]=<mark>,<now> is read with keyset pagination on id
+        (a record updated meanwhile leaves the window without shifting the others,
+        the next Sync gets it), the mark (kept in marks, a MarkStore) becomes <now>
+        once every record was yielded.
+        The first Sync yields everything. overlap: seconds subtracted from the mark
+        to also catch the records written late around the previous sync.
+        """
+        marks = marks if marks is not None else MarkStore()
+        key = self.url + "?" + "&".join(f"filter[{name}]={self.filter[name]}" for name in sorted(self.filter))
+        mark = marks.Get(key)
+        now = time.time()
+        start = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(max(0, mark - overlap) if mark is not None else 0))
+        ranges = dict(self.range, **{field: f"{start},{time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))}"})
+        method = self.Copy(range=ranges)
+        for data in method.IterPages(deadline=deadline, keyset="id"):
+            if isinstance(data, list):
+                yield from data
+            else:
+                yield data
+        marks.Set(key, now)
+
+    def Iter(self, prefetch=False, deadline=None, keyset=None):
+        """
+        yield each record of every page, one at a time
+        """
+        for data in self.IterPages(prefetch=prefetch, deadline=deadline, keyset=keyset):
+            if isinstance(data, list):
+                yield from data
+            else:
+                yield data
+
+    def Invalidate(self):
+        """
+        Forget the cached GET responses made stale by a POST, PATCH, PUT or DELETE on self.url
+        """
+        cache = getattr(self.session, "cache", None)
+        if cache is not None:
+            cache.Invalidate(self.url)
 
     def Post(self, data):
         """
         return response Object
         """
-        response = self.session.post(self.url, json=data)
+        self.Allow("POST")
+        response = self.session.post(self.url, json=data, **self.Options())
+        self.Invalidate()
         try:
             response.raise_for_status()
         except:
@@ -60,7 +1298,9 @@ class HttpMethod:
         """
         return response Object
         """
-        response = self.session.patch(self.url, json=data)
+        self.Allow("PATCH")
+        response = self.session.patch(self.url, json=data, **self.Options())
+        self.Invalidate()
         try:
             response.raise_for_status()
         except:
@@ -71,7 +1311,9 @@ class HttpMethod:
         """
         return response Object
         """
-        response = self.session.put(self.url, json=data)
+        self.Allow("PUT")
+        response = self.session.put(self.url, json=data, **self.Options())
+        self.Invalidate()
         try:
             response.raise_for_status()
         except:
@@ -82,1473 +1324,904 @@ class HttpMethod:
         """
         return response Object
         """
-        response = self.session.delete(self.url)
+        self.Allow("DELETE")
+        response = self.session.delete(self.url, **self.Options())
+        self.Invalidate()
         try:
             response.raise_for_status()
         except:
             raise Exception(f"[{response.status_code}] {response.content}")
         return response
 
-class FtApi:
+class Endpoint:
+
+    """
+    Method of FtApi built from the ENDPOINTS table.
+    The url template is picked from the parameters given, positionally or by name:
+    ftApi.Users() -> /v2/users, ftApi.Users(42) or ftApi.Users(id=42) -> /v2/users/42
+    """
+
+    def __init__(self, name, templates):
+        self.name = name
+        self.templates = sorted(((template, re.findall(r"{(\w+)}", template)) for template in templates),
+                key=lambda item: len(item[1]))
+        self.params = {param for _, params in self.templates for param in params}
+        self.__doc__ = 'More details: "https://api.intra.42.fr/apidoc/2.0/{}.html"'.format(templates[0].split("/")[2])
+
+    def __get__(self, instance, owner):
+        return self if instance is None else MethodType(self, instance)
+
+    def Resolve(self, args, kwargs):
+        """
+        return the url template matching args and the parameters named in kwargs
+        (they are popped from kwargs) with the extension built from it
+        """
+        named = {key: kwargs.pop(key) for key in list(kwargs) if key in self.params}
+        named = {key: value for key, value in named.items() if value is not None}
+        while args and args[-1] is None:
+            args = args[:-1]
+        for template, params in self.templates:
+            free = [param for param in params if param not in named]
+            if len(free) == len(args) and len(params) == len(free) + len(named):
+                return template, template.format(**named, **dict(zip(free, args)))
+        signatures = ", ".join(f"({', '.join(params)})" for _, params in self.templates)
+        raise TypeError(f"{self.name}() takes one of {signatures}")
 
-    def __init__(self, uid=None, secret=None, code=None, redirect=None, bearer=None, scope=None):
-        self.uid = uid if uid is not None else os.environ['UID42'] if bearer is None else ""
-        self.secret = secret if secret is not None else os.environ['SECRET42'] if bearer is None else ""
+    def __call__(self, api, *args, **kwargs):
+        template, extension = self.Resolve(args, kwargs)
+        if template in ENDPOINT_METHODS:
+            kwargs.setdefault("methods", ENDPOINT_METHODS[template])
+        return api.RawEndpoint(extension, **kwargs)
+
+class BaseApi:
+
+    """
+    Every endpoint of ENDPOINTS is a method: ftApi.Users(), ftApi.UsersLocations(user_id) ...
+    sent through self.session
+    """
+
+    def RawEndpoint(self, endpoint, **kwargs):
+        """
+        parameter : string
+        return : HttpMethod
+
+        Create a HttpMethod with passed parameter as the endpoint for "https://api.intra.42.fr/"
+
+        example :"/v2/users?filter[pool_year]=2019&page[size]=100&page[number]=3"
+        """
+        return HttpMethod(endpoint, self.session, **kwargs)
+
+    def __getattr__(self, name):
+        """
+        Resolve the endpoint methods from ENDPOINTS,
+        the Endpoint is then set on the class so it is only done once
+        """
+        if name not in ENDPOINTS:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        endpoint = Endpoint(name, ENDPOINTS[name])
+        setattr(type(self), name, endpoint)
+        return endpoint.__get__(self, type(self))
+
+    def __dir__(self):
+        return list(super().__dir__()) + list(ENDPOINTS)
+
+    def ColorizeJsonOutput(self, jsonObject):
+        """
+        pygments is only imported here (pip install FtApi[color]),
+        the json is printed without colors if it is not installed
+        """
+        jsonStr = json.dumps(jsonObject, indent=4, sort_keys=True)
+        try:
+            from pygments import highlight
+            from pygments.lexers import JsonLexer
+            from pygments.formatters import TerminalFormatter
+        except ImportError:
+            print(jsonStr)
+            return
+        print(highlight(jsonStr, JsonLexer(), TerminalFormatter()))
+
+class FtApi(BaseApi):
+
+    """
+    One 42 application: its bearer, rate limiter, retry policy and session
+    """
+
+    def __init__(self, uid=None, secret=None, code=None, redirect=None, bearer=None, scope=None, limiter=None, retry=None,
+            token_store=None, token_provider=None, cache=None, pool_connections=10, pool_maxsize=16, pool_block=False,
+            keep_alive=True, timeout=(10, 60), scheduler=None):
+        """
+        No request is made here: the bearer is asked the first time a request needs it.
+        token_provider: callable returning a bearer (string) or a token json,
+        used instead of /oauth/token
+        cache: ResponseCache used by the GET requests
+        pool_maxsize: connections kept alive, size it to the number of threads sharing
+        the FtApi (with pool_block=True the threads wait for a free connection instead)
+        timeout: seconds (or (connect, read) tuple) of every request, /oauth/token included,
+        a HttpMethod can have its own: ftApi.Users(timeout=5)
+        scheduler: priority lanes in front of the limiter, a HttpMethod picks its lane:
+        ftApi.Users(login, priority="interactive")
+        """
+        self.InitBearer(uid, secret, code, redirect, bearer, scope, token_store, token_provider)
+        self.limiter = RateLimiter() if limiter is None else limiter or None
+        self.retry = RetryPolicy() if retry is None else retry or None
+        self.scheduler = (Scheduler() if scheduler is None else scheduler or None) if self.limiter is not None else None
+        self.cache = cache
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.session = self.CreateSession()
+        if self.bearer is not None:
+            self.session.headers.update({'Authorization': 'Bearer {}'.format(self.bearer)})
+
+    def InitBearer(self, uid, secret, code, redirect, bearer, scope, token_store, token_provider):
+        """
+        credentials and token state (see __init__), without any request
+        """
+        self.uid = uid if uid is not None else os.environ['UID42'] if bearer is None and token_provider is None else ""
+        self.secret = secret if secret is not None else os.environ['SECRET42'] if bearer is None and token_provider is None else ""
         self.code = code
         self.redirect = redirect
         self.bearer = bearer
         self.scope = scope if scope is not None else "public projects profile elearning tig forum"
-        if self.bearer is None:
-            try:
-                self.bearer = self.GetBearer()
-            except Exception as e:
-                raise Exception(e)
-        self.session = requests.Session()
-        self.session.headers.update({'Authorization': 'Bearer {}'.format(self.bearer)})
+        self.token_store = token_store
+        self.token_provider = token_provider
+        self.expires_at = None
+        self.refresh_token = None
+        self.bearer_lock = threading.Lock()
+
+    def CreateSession(self):
+        renewable = bool(self.uid) or self.token_provider is not None
+        session = FtSession(self.limiter, self.retry, self.RefreshBearer if renewable else None,
+                self.EnsureBearer if renewable else None, self.cache, self.timeout, self.scheduler)
+        session.mount("https://", HTTPAdapter(pool_connections=self.pool_connections,
+                pool_maxsize=self.pool_maxsize, pool_block=self.pool_block))
+        if not self.keep_alive:
+            session.headers.update({'Connection': 'close'})
+        return session
 
     def FastInit(self):
         self.__init__(os.environ['UID42'], os.environ['SECRET42'])
 
-    def GetBearer(self):
+    def GetBearer(self, stale=None):
         """
         Makes a call to get Bearer with your crendentials
+        (or reuse the one of the token store if it is still valid and not stale)
         return: string
         """
-        if self.code:
+        if self.token_provider is not None:
+            token = self.token_provider()
+            token = {'access_token': token} if isinstance(token, str) else token
+        elif self.token_store is not None and not self.code:
+            token = self.token_store.Fetch(self.uid, self.scope, self.RequestToken, stale)
+        else:
+            token = self.RequestToken()
+        self.expires_at = token.get('expires_at')
+        self.refresh_token = token.get('refresh_token', self.refresh_token)
+        return token['access_token']
+
+    def RequestToken(self):
+        """
+        Ask /oauth/token for a new token
+        return: json with expires_at added
+        """
+        if self.code and self.refresh_token:
+            payload = {'grant_type':'refresh_token', 'client_id': self.uid,
+                    'client_secret': self.secret, 'refresh_token':self.refresh_token}
+        elif self.code:
             payload = {'grant_type':'authorization_code', 'client_id': self.uid,
                     'client_secret': self.secret, 'code':self.code, 'redirect_uri':self.redirect}
         else:
             payload = {'grant_type':'client_credentials', 'client_id': self.uid, "scope": self.scope,
                     'client_secret': self.secret}
         try:
-            response = requests.post("https://api.intra.42.fr/oauth/token", data=payload)
+            response = requests.post("https://api.intra.42.fr/oauth/token", data=payload, timeout=self.timeout)
             if response.status_code != 200:
                 raise Exception("wrong status_code:{}".format(response.status_code))
             parsed_response = json.loads(response.content.decode('utf-8'))
         except Exception as e:
             raise Exception(e)
-        return parsed_response['access_token']
+        if 'expires_in' in parsed_response:
+            parsed_response['expires_at'] = time.time() + parsed_response['expires_in']
+        return parsed_response
 
-    def ReloadBearer(self):
+    def BearerExpiring(self):
         """
-        Use this method in case 'The access token expired'
+        True when a request needs a new bearer (none yet, or about to expire)
         """
-        self.bearer = self.GetBearer()
-        self.session = requests.Session()
-        self.session.headers.update({'Authorization': 'Bearer {}'.format(self.bearer)})
+        return self.bearer is None or (self.expires_at is not None and self.expires_at - 30 < time.time())
 
-    def RawEndpoint(self, endpoint, **kwargs):
+    def EnsureBearer(self):
         """
-        parameter : string
-        return : HttpMethod
-
-        Create a HttpMethod with passed parameter as the endpoint for "https://api.intra.42.fr/"
-
-        example :"/v2/users?filter[pool_year]=2019&page[size]=100&page[number]=3"
+        Get the bearer the first time a request needs it,
+        or a new one when the current one is about to expire
         """
-        return HttpMethod(endpoint, self.session, **kwargs)
+        if self.BearerExpiring():
+            with self.bearer_lock:
+                if self.BearerExpiring():
+                    self.bearer = self.GetBearer(stale=self.bearer)
+                    self.session.headers.update({'Authorization': 'Bearer {}'.format(self.bearer)})
+        return self.bearer
 
-    def ColorizeJsonOutput(self, jsonObject):
-        jsonStr = json.dumps(jsonObject, indent=4, sort_keys=True)
-        print(highlight(jsonStr, JsonLexer(), TerminalFormatter()))
-
-    def Accreditations(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/accreditations.html"
-        """
-        extension = "/v2/accreditations/{}".format(id) if id is not None else "/v2/accreditations"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Achievements(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/achievements.html"
-        """
-        extension = "/v2/achievements/{}".format(id) if id is not None else "/v2/achievements"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Achievements_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/achievements_users.html"
-        """
-        extension = "/v2/achievements_users/{}".format(id) if id is not None else "/v2/achievements_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Announcements(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/announcements.html"
-        """
-        extension = "/v2/announcements/{}".format(id) if id is not None else "/v2/announcements"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Anti_grav_units(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/anti_grav_units.html"
-        """
-        extension = "/v2/anti_grav_units/{}".format(id) if id is not None else "/v2/anti_grav_units"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Anti_grav_units_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/anti_grav_units_users.html"
-        """
-        extension = "/v2/anti_grav_units_users/{}".format(id) if id is not None else "/v2/anti_grav_units_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Apps(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/apps.html"
-        """
-        extension = "/v2/apps/{}".format(id) if id is not None else "/v2/apps"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Attachments(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/attachments.html"
-        """
-        extension = "/v2/attachments/{}".format(id) if id is not None else "/v2/attachments"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Balances(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/balances.html"
-        """
-        extension = "/v2/balances/{}".format(id) if id is not None else "/v2/balances"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Bloc_deadlines(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/bloc_deadlines.html"
-        """
-        extension = "/v2/bloc_deadlines/{}".format(id) if id is not None else "/v2/bloc_deadlines"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Blocs(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/blocs.html"
-        """
-        extension = "/v2/blocs/{}".format(id) if id is not None else "/v2/blocs"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Campus(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/campus.html"
-        """
-        extension = "/v2/campus/{}".format(id) if id is not None else "/v2/campus"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Campus_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/campus_users.html"
-        """
-        extension = "/v2/campus_users/{}".format(id) if id is not None else "/v2/campus_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Certificates(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/certificates.html"
-        """
-        extension = "/v2/certificates/{}".format(id) if id is not None else "/v2/certificates"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Certificates_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/certificates_users.html"
-        """
-        extension = "/v2/certificates_users/{}".format(id) if id is not None else "/v2/certificates_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Closes(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/closes.html"
-        """
-        extension = "/v2/closes/{}".format(id) if id is not None else "/v2/closes"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Coalitions(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/coalitions.html"
-        """
-        extension = "/v2/coalitions/{}".format(id) if id is not None else "/v2/coalitions"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Coalitions_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/coalitions_users.html"
-        """
-        extension = "/v2/coalitions_users/{}".format(id) if id is not None else "/v2/coalitions_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Community_services(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/community_services.html"
-        """
-        extension = "/v2/community_services/{}".format(id) if id is not None else "/v2/community_services"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Companies(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/companies.html"
-        """
-        extension = "/v2/companies/{}".format(id) if id is not None else "/v2/companies"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Cursus(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/cursus.html"
-        """
-        extension = "/v2/cursus/{}".format(id) if id is not None else "/v2/cursus"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Cursus_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/cursus_users.html"
-        """
-        extension = "/v2/cursus_users/{}".format(id) if id is not None else "/v2/cursus_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Dashes(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/dashes.html"
-        """
-        extension = "/v2/dashes/{}".format(id) if id is not None else "/v2/dashes"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Dashes_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/dashes_users.html"
-        """
-        extension = "/v2/dashes_users/{}".format(id) if id is not None else "/v2/dashes_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Endpoints(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/endpoints.html"
-        """
-        extension = "/v2/endpoints/{}".format(id) if id is not None else "/v2/endpoints"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Evaluations(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/evaluations.html"
-        """
-        extension = "/v2/evaluations/{}".format(id) if id is not None else "/v2/evaluations"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Events(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/events.html"
-        """
-        extension = "/v2/events/{}".format(id) if id is not None else "/v2/events"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Events_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/events_users.html"
-        """
-        extension = "/v2/events_users/{}".format(id) if id is not None else "/v2/events_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Exams(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/exams.html"
-        """
-        extension = "/v2/exams/{}".format(id) if id is not None else "/v2/exams"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Experiences(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/experiences.html"
-        """
-        extension = "/v2/experiences/{}".format(id) if id is not None else "/v2/experiences"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Expertises(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/expertises.html"
-        """
-        extension = "/v2/expertises/{}".format(id) if id is not None else "/v2/expertises"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Expertises_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/expertises_users.html"
-        """
-        extension = "/v2/expertises_users/{}".format(id) if id is not None else "/v2/expertises_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Feedbacks(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/feedbacks.html"
-        """
-        extension = "/v2/feedbacks/{}".format(id) if id is not None else "/v2/feedbacks"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Flash_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/flash_users.html"
-        """
-        extension = "/v2/flash_users/{}".format(id) if id is not None else "/v2/flash_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Flashes(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/flashes.html"
-        """
-        extension = "/v2/flashes/{}".format(id) if id is not None else "/v2/flashes"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Groups(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/groups.html"
-        """
-        extension = "/v2/groups/{}".format(id) if id is not None else "/v2/groups"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Groups_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/groups_users.html"
-        """
-        extension = "/v2/groups_users/{}".format(id) if id is not None else "/v2/groups_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Internships(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/internships.html"
-        """
-        extension = "/v2/internships/{}".format(id) if id is not None else "/v2/internships"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Languages(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/languages.html"
-        """
-        extension = "/v2/languages/{}".format(id) if id is not None else "/v2/languages"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Languages_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/languages_users.html"
-        """
-        extension = "/v2/languages_users/{}".format(id) if id is not None else "/v2/languages_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Locations(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/locations.html"
-        """
-        extension = "/v2/locations/{}".format(id) if id is not None else "/v2/locations"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Mailings(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/mailings.html"
-        """
-        extension = "/v2/mailings/{}".format(id) if id is not None else "/v2/mailings"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Notes(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/notes.html"
-        """
-        extension = "/v2/notes/{}".format(id) if id is not None else "/v2/notes"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Notions(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/notions.html"
-        """
-        extension = "/v2/notions/{}".format(id) if id is not None else "/v2/notions"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Offers(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/offers.html"
-        """
-        extension = "/v2/offers/{}".format(id) if id is not None else "/v2/offers"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Offers_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/offers_users.html"
-        """
-        extension = "/v2/offers_users/{}".format(id) if id is not None else "/v2/offers_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Params_project_sessions_rules(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/params_project_sessions_rules.html"
-        """
-        extension = "/v2/params_project_sessions_rules/{}".format(id) if id is not None else "/v2/params_project_sessions_rules"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Partnerships(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/partnerships.html"
-        """
-        extension = "/v2/partnerships/{}".format(id) if id is not None else "/v2/partnerships"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Partnerships_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/partnerships_users.html"
-        """
-        extension = "/v2/partnerships_users/{}".format(id) if id is not None else "/v2/partnerships_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Patronages(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/patronages.html"
-        """
-        extension = "/v2/patronages/{}".format(id) if id is not None else "/v2/patronages"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Patronages_reports(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/patronages_reports.html"
-        """
-        extension = "/v2/patronages_reports/{}".format(id) if id is not None else "/v2/patronages_reports"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Pools(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/pools.html"
-        """
-        extension = "/v2/pools/{}".format(id) if id is not None else "/v2/pools"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Products(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/products.html"
-        """
-        extension = "/v2/products/{}".format(id) if id is not None else "/v2/products"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_data(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/project_data.html"
-        """
-        extension = "/v2/project_data/{}".format(id) if id is not None else "/v2/project_data"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessions(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/project_sessions.html"
-        """
-        extension = "/v2/project_sessions/{}".format(id) if id is not None else "/v2/project_sessions"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessions_rules(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/project_sessions_rules.html"
-        """
-        extension = "/v2/project_sessions_rules/{}".format(id) if id is not None else "/v2/project_sessions_rules"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessions_skills(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/project_sessions_skills.html"
-        """
-        extension = "/v2/project_sessions_skills/{}".format(id) if id is not None else "/v2/project_sessions_skills"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Projects(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/projects.html"
-        """
-        extension = "/v2/projects/{}".format(id) if id is not None else "/v2/projects"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Projects_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/projects_users.html"
-        """
-        extension = "/v2/projects_users/{}".format(id) if id is not None else "/v2/projects_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Quests(self, id=None, **kwargs):
+    def ReloadBearer(self):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/quests.html"
+        Use this method in case 'The access token expired'
+        (401 responses already trigger it automatically)
         """
-        extension = "/v2/quests/{}".format(id) if id is not None else "/v2/quests"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Quests_users(self, id=None, **kwargs):
+        self.RefreshBearer()
+
+    def RefreshBearer(self, sent=None):
+        """
+        Get a new bearer and update the Authorization header of the session in place,
+        so the pooled connections and the HttpMethod already created are kept.
+        sent is the Authorization header of the request which got a 401:
+        if another thread already refreshed it, nothing is done.
+        """
+        with self.bearer_lock:
+            if sent is None or self.session.headers.get('Authorization') == sent:
+                self.bearer = self.GetBearer(stale=self.bearer)
+                self.session.headers.update({'Authorization': 'Bearer {}'.format(self.bearer)})
+        return self.bearer
+
+    def Budget(self):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/quests_users.html"
+        return the rate limit budget of the application, None without limiter:
+        {'uid', 'per_second', 'per_hour', 'hourly_remaining', 'reset_in' (seconds), 'tokens'}
         """
-        extension = "/v2/quests_users/{}".format(id) if id is not None else "/v2/quests_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Roles(self, id=None, **kwargs):
+        budget = self.session.Budget()
+        return dict(budget, uid=self.uid) if budget is not None else None
+
+class PoolSession:
+
+    """
+    Session of a FtApiPool: every request is sent by the session of the application
+    which can send it the soonest, then has the most hourly requests left.
+    With a scheduler, the request waits for its turn in its priority lane first.
+    """
+
+    def __init__(self, apis, cache=None, scheduler=None):
+        self.apis = apis
+        self.cache = cache
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+
+    def Order(self, api):
+        if api.limiter is None:
+            return (0.0, 0)
+        return (api.limiter.Wait(), -api.limiter.Remaining())
+
+    def Budget(self):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/roles.html"
+        the budgets of the applications added up (reset_in is the latest one)
         """
-        extension = "/v2/roles/{}".format(id) if id is not None else "/v2/roles"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Roles_entities(self, id=None, **kwargs):
+        budgets = [api.limiter.Budget() for api in self.apis if api.limiter is not None]
+        if not budgets:
+            return None
+        total = {name: sum(budget[name] for budget in budgets) for name in budgets[0]}
+        total['reset_in'] = max(budget['reset_in'] for budget in budgets)
+        return total
+
+    def request(self, method, url, priority=None, **kwargs):
+        # the token is taken while choosing, so concurrent requests spread over the apps
+        with self.scheduler.Turn(priority, kwargs.get('end')) if self.scheduler is not None else self.lock:
+            if self.scheduler is not None:
+                FtSession.Sleep(min(self.Order(api)[0] for api in self.apis), kwargs.get('end'))
+            api = min(self.apis, key=self.Order)
+            reserved = api.limiter.Reserve() if api.limiter is not None else None
+        return api.session.request(method, url, reserved=reserved, priority=priority, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+class FtApiPool(BaseApi):
+
+    """
+    Several applications of the same owner used as one FtApi: each keeps its
+    bearer and its RateLimiter, every request goes to the app with the most budget left
+    pool = FtApiPool([(uid1, secret1), (uid2, secret2)])
+    """
+
+    def __init__(self, credentials, cache=None, scheduler=None, **kwargs):
+        """
+        credentials: (uid, secret) tuples or dicts of FtApi arguments, one per application
+        kwargs: given to the FtApi of every application (don't share a limiter between them)
+        cache: ResponseCache shared by the applications
+        scheduler: priority lanes in front of the choice of the application (see FtApi)
+        """
+        # the retries of an application don't wait in the lanes again
+        kwargs['scheduler'] = False
+        self.apis = [FtApi(**dict(kwargs, **app)) if isinstance(app, dict) else FtApi(*app, **kwargs) for app in credentials]
+        if not self.apis:
+            raise Exception("FtApiPool needs at least one application")
+        limited = any(api.limiter is not None for api in self.apis)
+        self.scheduler = (Scheduler() if scheduler is None else scheduler or None) if limited else None
+        self.cache = cache
+        self.session = PoolSession(self.apis, cache, self.scheduler)
+
+    def ReloadBearer(self):
+        for api in self.apis:
+            api.ReloadBearer()
+
+    def Budget(self):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/roles_entities.html"
+        return the budget of each application (see FtApi.Budget)
         """
-        extension = "/v2/roles_entities/{}".format(id) if id is not None else "/v2/roles_entities"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Rules(self, id=None, **kwargs):
+        return [api.Budget() for api in self.apis]
+
+class AsyncResponse:
+
+    """
+    Status, headers and body of an aiohttp response,
+    read before the connection goes back to the pool
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"[{self.status_code}] {self.content}")
+
+class AsyncFtSession:
+
+    """
+    asyncio counterpart of FtSession on top of aiohttp.
+    asyncio and aiohttp are imported on first use to keep "import FtApi" cheap.
+    Uses the same rate limiter, retry policy and bearer hooks, the connections
+    are shared by every coroutine through a pool of pool_size connections.
+    expiring() is checked on the event loop before each request, authorize()
+    (which may ask /oauth/token) only runs on a thread when it returns True.
+    A limiter sharing its bucket out of the process (FileRateLimiter...) waits
+    for locks and files: it is called on a thread too.
+    """
+
+    def __init__(self, limiter=None, retry=None, refresh=None, authorize=None, pool_size=10, timeout=None, expiring=None):
+        self.limiter = limiter
+        self.retry = retry
+        self.refresh = refresh
+        self.authorize = authorize
+        self.expiring = expiring
+        self.shared = limiter is not None and type(limiter).Shared is not RateLimiter.Shared
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = {}
+        self.client = None
+
+    def Client(self):
+        if self.client is None:
+            import aiohttp
+            self.client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self.client
+
+    @staticmethod
+    def ClientTimeout(timeout):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/rules.html"
+        requests style timeout (seconds or (connect, read)) -> aiohttp.ClientTimeout
         """
-        extension = "/v2/rules/{}".format(id) if id is not None else "/v2/rules"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Scale_teams(self, id=None, **kwargs):
+        import aiohttp
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        return aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+
+    def Budget(self):
+        return self.limiter.Budget() if self.limiter is not None else None
+
+    async def request(self, method, url, json=None, timeout=None):
+        import asyncio
+        import aiohttp
+        client = self.Client()
+        loop = asyncio.get_running_loop()
+        timeout = self.ClientTimeout(timeout if timeout is not None else self.timeout)
+        attempt = 0
+        refreshed = False
+        while True:
+            if self.authorize is not None and (self.expiring is None or self.expiring()):
+                await loop.run_in_executor(None, self.authorize)
+            if self.limiter is not None:
+                wait = await loop.run_in_executor(None, self.limiter.Reserve) if self.shared else self.limiter.Reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            sent = self.headers.get('Authorization')
+            try:
+                async with client.request(method, url, json=json, headers=self.headers, timeout=timeout) as raw:
+                    response = AsyncResponse(raw.status, raw.headers, await raw.read())
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                if self.retry is None or not self.retry.ShouldRetry(method, attempt):
+                    raise
+                await asyncio.sleep(self.retry.Backoff(attempt))
+                attempt += 1
+                continue
+            if self.limiter is not None:
+                if self.shared:
+                    await loop.run_in_executor(None, self.limiter.Update, response.headers)
+                else:
+                    self.limiter.Update(response.headers)
+            if response.status_code == 401 and self.refresh is not None and not refreshed:
+                refreshed = True
+                await loop.run_in_executor(None, self.refresh, sent)
+                continue
+            if self.retry is None or not self.retry.ShouldRetry(method, attempt, response.status_code):
+                return response
+            await asyncio.sleep(self.retry.Backoff(attempt, response.headers.get("Retry-After")))
+            attempt += 1
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+class AsyncHttpMethod(BaseHttpMethod):
+
+    """
+    HttpMethod of AsyncFtApi, same parameters but priority and controller:
+    Get, GetAll, Post, Patch, Put, Delete are coroutines
+    and IterPages, Iter are async generators.
+    Deadlines and keyset pagination are only in HttpMethod.
+    """
+
+    def __init__(self, extension, session, **kwargs):
+        for name in ("priority", "controller"):
+            if kwargs.get(name) is not None:
+                raise NotImplementedError(f"{name} is not supported by AsyncFtApi")
+        super().__init__(extension, session, **kwargs)
+
+    @staticmethod
+    def Unsupported(name, deadline=None, keyset=None):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/scale_teams.html"
+        raise for the parts of HttpMethod which have no asyncio version
         """
-        extension = "/v2/scale_teams/{}".format(id) if id is not None else "/v2/scale_teams"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Scales(self, id=None, **kwargs):
+        if name is None and deadline is None and keyset is None:
+            return
+        what = name or ("deadline" if deadline is not None else "keyset")
+        raise NotImplementedError(f"{what} is not supported by AsyncFtApi, use FtApi")
+
+    async def Fetch(self, number=None):
+        self.Allow("GET")
+        response = await self.session.request("GET", self.url + self.ParseParams(number), timeout=self.timeout)
+        response.raise_for_status()
+        return json.loads(response.text), response
+
+    async def Get(self):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/scales.html"
+        return json of the current page and move to the next one
         """
-        extension = "/v2/scales/{}".format(id) if id is not None else "/v2/scales"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Scores(self, id=None, **kwargs):
+        if not self.page or "number" not in self.page:
+            return (await self.Fetch())[0]
+        number = self.NextPage()
+        try:
+            return (await self.Fetch(number))[0]
+        except Exception:
+            self.PageFailed(number)
+            raise
+
+    async def GetAll(self, workers=1, deadline=None, keyset=None):
+        """
+        return every record of every page in a single list (in page order)
+        with workers > 1, at most workers pages are requested at the same time
+        """
+        self.Unsupported(None if isinstance(workers, int) else f"workers={workers!r}", deadline, keyset)
+        if not self.page:
+            return (await self.Fetch())[0]
+        number = self.page.get('number', 1)
+        data, response = await self.Fetch(number)
+        if not isinstance(data, list):
+            return data
+        result = list(data)
+        last = self.LastPageNumber(response)
+        if workers > 1 and last is not None:
+            import asyncio
+            semaphore = asyncio.Semaphore(workers)
+            async def FetchPage(number):
+                async with semaphore:
+                    return (await self.Fetch(number))[0]
+            for page in await asyncio.gather(*(FetchPage(number) for number in range(number + 1, last + 1))):
+                result.extend(page)
+            return result
+        while not self.IsLastPage(data, response, number):
+            number += 1
+            data, response = await self.Fetch(number)
+            result.extend(data)
+        return result
+
+    async def IterPages(self, prefetch=False, deadline=None, keyset=None):
+        """
+        yield each page (json) from the current page number until the last one
+        prefetch=True requests the next page while the current one is processed
+        """
+        self.Unsupported(None, deadline, keyset)
+        if not self.page:
+            yield (await self.Fetch())[0]
+            return
+        import asyncio
+        number = self.page.get('number', 1)
+        pending = None
+        try:
+            data, response = await self.Fetch(number)
+            while True:
+                last = self.IsLastPage(data, response, number)
+                pending = asyncio.ensure_future(self.Fetch(number + 1)) if prefetch and not last else None
+                if data:
+                    yield data
+                if last:
+                    return
+                number += 1
+                data, response = await pending if pending else await self.Fetch(number)
+                pending = None
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def Iter(self, prefetch=False, deadline=None, keyset=None):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/scores.html"
+        yield each record of every page, one at a time
         """
-        extension = "/v2/scores/{}".format(id) if id is not None else "/v2/scores"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Skills(self, id=None, **kwargs):
+        async for data in self.IterPages(prefetch=prefetch, deadline=deadline, keyset=keyset):
+            if isinstance(data, list):
+                for record in data:
+                    yield record
+            else:
+                yield data
+
+    async def Send(self, method, data=None):
+        self.Allow(method)
+        response = await self.session.request(method, self.url, json=data, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    async def Post(self, data):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/skills.html"
+        return AsyncResponse
         """
-        extension = "/v2/skills/{}".format(id) if id is not None else "/v2/skills"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Slots(self, id=None, **kwargs):
+        return await self.Send("POST", data)
+
+    async def Patch(self, data):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/slots.html"
+        return AsyncResponse
         """
-        extension = "/v2/slots/{}".format(id) if id is not None else "/v2/slots"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Subnotions(self, id=None, **kwargs):
+        return await self.Send("PATCH", data)
+
+    async def Put(self, data):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/subnotions.html"
+        return AsyncResponse
         """
-        extension = "/v2/subnotions/{}".format(id) if id is not None else "/v2/subnotions"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Tags(self, id=None, **kwargs):
+        return await self.Send("PUT", data)
+
+    async def Delete(self):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/tags.html"
+        return AsyncResponse
         """
-        extension = "/v2/tags/{}".format(id) if id is not None else "/v2/tags"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Tags_users(self, id=None, **kwargs):
+        return await self.Send("DELETE")
+
+class AsyncFtApi(FtApi):
+
+    """
+    FtApi on asyncio with the same endpoints (pip install FtApi[async]):
+
+        async with AsyncFtApi(uid, secret) as ftApi:
+            users = await ftApi.Users().GetAll(workers=8)
+
+    The rate limiter, retry policy and bearer logic are the ones of FtApi.
+    """
+
+    def __init__(self, uid=None, secret=None, code=None, redirect=None, bearer=None, scope=None, limiter=None, retry=None,
+            token_store=None, token_provider=None, pool_maxsize=16, timeout=(10, 60), cache=None):
+        """
+        same parameters as FtApi but the ones of requests, the Scheduler and the cache,
+        pool_maxsize: connections of the aiohttp pool
+        """
+        if cache is not None:
+            raise NotImplementedError("cache is not supported by AsyncFtApi")
+        self.InitBearer(uid, secret, code, redirect, bearer, scope, token_store, token_provider)
+        self.limiter = RateLimiter() if limiter is None else limiter or None
+        self.retry = RetryPolicy() if retry is None else retry or None
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.session = self.CreateSession()
+        if self.bearer is not None:
+            self.session.headers.update({'Authorization': 'Bearer {}'.format(self.bearer)})
+
+    def CreateSession(self):
+        renewable = bool(self.uid) or self.token_provider is not None
+        return AsyncFtSession(self.limiter, self.retry, self.RefreshBearer if renewable else None,
+                self.EnsureBearer if renewable else None, self.pool_maxsize, self.timeout, self.BearerExpiring)
+
+    def RawEndpoint(self, endpoint, **kwargs):
         """
-        More details: "https://api.intra.42.fr/apidoc/2.0/tags_users.html"
+        parameter : string
+        return : AsyncHttpMethod
         """
-        extension = "/v2/tags_users/{}".format(id) if id is not None else "/v2/tags_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Teams(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/teams.html"
-        """
-        extension = "/v2/teams/{}".format(id) if id is not None else "/v2/teams"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Teams_uploads(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/teams_uploads.html"
-        """
-        extension = "/v2/teams_uploads/{}".format(id) if id is not None else "/v2/teams_uploads"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Teams_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/teams_users.html"
-        """
-        extension = "/v2/teams_users/{}".format(id) if id is not None else "/v2/teams_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Titles(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/titles.html"
-        """
-        extension = "/v2/titles/{}".format(id) if id is not None else "/v2/titles"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Titles_users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/titles_users.html"
-        """
-        extension = "/v2/titles_users/{}".format(id) if id is not None else "/v2/titles_users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Transactions(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/transactions.html"
-        """
-        extension = "/v2/transactions/{}".format(id) if id is not None else "/v2/transactions"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Translations(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/translations.html"
-        """
-        extension = "/v2/translations/{}".format(id) if id is not None else "/v2/translations"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def User_candidatures(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/user_candidatures.html"
-        """
-        extension = "/v2/user_candidatures/{}".format(id) if id is not None else "/v2/user_candidatures"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Users(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/users.html"
-        """
-        extension = "/v2/users/{}".format(id) if id is not None else "/v2/users"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Waitlists(self, id=None, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/waitlists.html"
-        """
-        extension = "/v2/waitlists/{}".format(id) if id is not None else "/v2/waitlists"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def AccreditationsUsers(self, accreditation_id, **kwargs):
-        extension = "/v2/accreditations/{}/users".format(accreditation_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def AchievementsUsers(self, achievement_id, **kwargs):
-        extension = "/v2/achievements/{}/users".format(achievement_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def AchievementsAchievements_users(self, achievement_id, **kwargs):
-        extension = "/v2/achievements/{}/achievements_users".format(achievement_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def BlocsSquads(self, bloc_id, **kwargs):
-        extension = "/v2/blocs/{}/squads".format(bloc_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def BlocsScores(self, bloc_id, **kwargs):
-        extension = "/v2/blocs/{}/scores".format(bloc_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def BlocsScores(self, bloc_id, id, **kwargs):
-        extension = "/v2/blocs/{}/scores/{}".format(bloc_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def BlocsCoalitions(self, bloc_id, **kwargs):
-        extension = "/v2/blocs/{}/coalitions".format(bloc_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def BlocsSquads(self, bloc_id, id, **kwargs):
-        extension = "/v2/blocs/{}/squads/{}".format(bloc_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def BlocsSquads_users(self, bloc_id, **kwargs):
-        extension = "/v2/blocs/{}/squads_users".format(bloc_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def BlocsBloc_deadlines(self, bloc_id, **kwargs):
-        extension = "/v2/blocs/{}/bloc_deadlines".format(bloc_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def BlocsSquads_users(self, bloc_id, id, **kwargs):
-        extension = "/v2/blocs/{}/squads_users/{}".format(bloc_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusJournal(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/campusjournal.html"
-        """
-        extension = "/v2/campus/journal"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusNotes(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/notes".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusUsers(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/users".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusExams(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/exams".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusStats(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/stats".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusQuests(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/quests".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusEvents(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/events".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusProducts(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/products".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusLocations(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/locations".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusBroadcasts(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/broadcasts".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusTags_users(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/tags_users".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusAchievements(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/achievements".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusProducts(self, campus_id, id, **kwargs):
-        extension = "/v2/campus/{}/products/{}".format(campus_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusLocationsEnd_all(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/locations/end_all".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusAnti_grav_units_users(self, campus_id, **kwargs):
-        extension = "/v2/campus/{}/anti_grav_units_users".format(campus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusCursusExams(self, campus_id, cursus_id, **kwargs):
-        extension = "/v2/campus/{}/cursus/{}/exams".format(campus_id, cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusCursusEvents(self, campus_id, cursus_id, **kwargs):
-        extension = "/v2/campus/{}/cursus/{}/events".format(campus_id, cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CampusProductsCommands(self, campus_id, product_id, **kwargs):
-        extension = "/v2/campus/{}/products/{}/commands".format(campus_id, product_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CertificatesCertificates_users(self, certificate_id, **kwargs):
-        extension = "/v2/certificates/{}/certificates_users".format(certificate_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ClosesClose(self, id, **kwargs):
-        extension = "/v2/closes/{}/close".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ClosesUnclose(self, id, **kwargs):
-        extension = "/v2/closes/{}/unclose".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ClosesCommunity_services(self, close_id, **kwargs):
-        extension = "/v2/closes/{}/community_services".format(close_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CoalitionsUsers(self, coalition_id, **kwargs):
-        extension = "/v2/coalitions/{}/users".format(coalition_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CoalitionsScores(self, coalition_id, **kwargs):
-        extension = "/v2/coalitions/{}/scores".format(coalition_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CoalitionsScores(self, coalition_id, id, **kwargs):
-        extension = "/v2/coalitions/{}/scores/{}".format(coalition_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CoalitionsCoalitions_users(self, coalition_id, **kwargs):
-        extension = "/v2/coalitions/{}/coalitions_users".format(coalition_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Coalitions_usersScores(self, coalitions_user_id, **kwargs):
-        extension = "/v2/coalitions_users/{}/scores".format(coalitions_user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Coalitions_usersScores(self, coalitions_user_id, id, **kwargs):
-        extension = "/v2/coalitions_users/{}/scores/{}".format(coalitions_user_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Community_servicesValidate(self, id, **kwargs):
-        extension = "/v2/community_services/{}/validate".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Community_servicesInvalidate(self, id, **kwargs):
-        extension = "/v2/community_services/{}/invalidate".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CompaniesSubscribed_users(self, company_id, **kwargs):
-        extension = "/v2/companies/{}/subscribed_users".format(company_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CompaniesInternships_users(self, company_id, **kwargs):
-        extension = "/v2/companies/{}/internships_users".format(company_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusTags(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/tags".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusExams(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/exams".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusTeams(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/teams".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusUsers(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/users".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusQuests(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/quests".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusEvents(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/events".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusSkills(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/skills".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusLevels(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/levels".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusNotions(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/notions".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusProjects(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/projects".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusTags_users(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/tags_users".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusAchievements(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/achievements".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusCursus_users(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/cursus_users".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def CursusAnnouncements(self, cursus_id, **kwargs):
-        extension = "/v2/cursus/{}/announcements".format(cursus_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def DashesUsers(self, dash_id, **kwargs):
-        extension = "/v2/dashes/{}/users".format(dash_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def DashesDashes_users(self, dash_id, **kwargs):
-        extension = "/v2/dashes/{}/dashes_users".format(dash_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def EventsUsers(self, event_id, **kwargs):
-        extension = "/v2/events/{}/users".format(event_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def EventsWaitlist(self, event_id, **kwargs):
-        extension = "/v2/events/{}/waitlist".format(event_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def EventsFeedbacks(self, event_id, **kwargs):
-        extension = "/v2/events/{}/feedbacks".format(event_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def EventsEvents_users(self, event_id, **kwargs):
-        extension = "/v2/events/{}/events_users".format(event_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def EventsFeedbacks(self, event_id, id, **kwargs):
-        extension = "/v2/events/{}/feedbacks/{}".format(event_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ExamsWaitlist(self, exam_id, **kwargs):
-        extension = "/v2/exams/{}/waitlist".format(exam_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ExamsExams_users(self, exam_id, **kwargs):
-        extension = "/v2/exams/{}/exams_users".format(exam_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ExamsExams_users(self, exam_id, id, **kwargs):
-        extension = "/v2/exams/{}/exams_users/{}".format(exam_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ExpertisesUsers(self, expertise_id, **kwargs):
-        extension = "/v2/expertises/{}/users".format(expertise_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ExpertisesExpertises_users(self, expertise_id, **kwargs):
-        extension = "/v2/expertises/{}/expertises_users".format(expertise_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Flags(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/flags.html"
-        """
-        extension = "/v2/flags"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def FlashesFlash_users(self, flash_id, **kwargs):
-        extension = "/v2/flashes/{}/flash_users".format(flash_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def FlashesFlash_users(self, flash_id, id, **kwargs):
-        extension = "/v2/flashes/{}/flash_users/{}".format(flash_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def GroupsUsers(self, group_id, **kwargs):
-        extension = "/v2/groups/{}/users".format(group_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def GroupsGroups_users(self, group_id, **kwargs):
-        extension = "/v2/groups/{}/groups_users".format(group_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def IssuesTags(self, issue_id, **kwargs):
-        extension = "/v2/issues/{}/tags".format(issue_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Levels(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/levels.html"
-        """
-        extension = "/v2/levels"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Me(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/me.html"
-        """
-        extension = "/v2/me"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def MeSlots(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/meslots.html"
-        """
-        extension = "/v2/me/slots"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def MeTeams(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/meteams.html"
-        """
-        extension = "/v2/me/teams"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def MeProjects(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/meprojects.html"
-        """
-        extension = "/v2/me/projects"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def MeScale_teams(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/mescale_teams.html"
-        """
-        extension = "/v2/me/scale_teams"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def MeScale_teamsAs_corrector(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/mescale_teamsas_corrector.html"
-        """
-        extension = "/v2/me/scale_teams/as_corrector"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def MeScale_teamsAs_corrected(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/mescale_teamsas_corrected.html"
-        """
-        extension = "/v2/me/scale_teams/as_corrected"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def NotionsTags(self, notion_id, **kwargs):
-        extension = "/v2/notions/{}/tags".format(notion_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def NotionsSubnotions(self, notion_id, **kwargs):
-        extension = "/v2/notions/{}/subnotions".format(notion_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def OffersOffers_users(self, offer_id, **kwargs):
-        extension = "/v2/offers/{}/offers_users".format(offer_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def PartnershipsUsers(self, partnership_id, **kwargs):
-        extension = "/v2/partnerships/{}/users".format(partnership_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def PartnershipsPartnerships_users(self, partnership_id, **kwargs):
-        extension = "/v2/partnerships/{}/partnerships_users".format(partnership_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Partnerships_usersExperiences(self, partnerships_user_id, **kwargs):
-        extension = "/v2/partnerships_users/{}/experiences".format(partnerships_user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def PatronagesPatronages_reports(self, patronage_id, **kwargs):
-        extension = "/v2/patronages/{}/patronages_reports".format(patronage_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def PoolsPointsAdd(self, id, **kwargs):
-        extension = "/v2/pools/{}/points/add".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def PoolsPointsRemove(self, id, **kwargs):
-        extension = "/v2/pools/{}/points/remove".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def PoolsBalances(self, pool_id, **kwargs):
-        extension = "/v2/pools/{}/balances".format(pool_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def PoolsBalances(self, pool_id, id, **kwargs):
-        extension = "/v2/pools/{}/balances/{}".format(pool_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProductsCommands(self, product_id, **kwargs):
-        extension = "/v2/products/{}/commands".format(product_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsTeams(self, project_session_id, **kwargs):
-        extension = "/v2/project_sessions/{}/teams".format(project_session_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsRules(self, project_session_id, **kwargs):
-        extension = "/v2/project_sessions/{}/rules".format(project_session_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsScales(self, project_session_id, **kwargs):
-        extension = "/v2/project_sessions/{}/scales".format(project_session_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsScale_teams(self, project_session_id, **kwargs):
-        extension = "/v2/project_sessions/{}/scale_teams".format(project_session_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsAttachments(self, project_session_id, **kwargs):
-        extension = "/v2/project_sessions/{}/attachments".format(project_session_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsProject_data(self, project_session_id, **kwargs):
-        extension = "/v2/project_sessions/{}/project_data".format(project_session_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsScale_teams(self, project_session_id, id, **kwargs):
-        extension = "/v2/project_sessions/{}/scale_teams/{}".format(project_session_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsAttachments(self, project_session_id, id, **kwargs):
-        extension = "/v2/project_sessions/{}/attachments/{}".format(project_session_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsProject_sessions_rules(self, project_session_id, **kwargs):
-        extension = "/v2/project_sessions/{}/project_sessions_rules".format(project_session_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsProject_sessions_skills(self, project_session_id, **kwargs):
-        extension = "/v2/project_sessions/{}/project_sessions_skills".format(project_session_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessionsProject_sessions_skills(self, project_session_id, id, **kwargs):
-        extension = "/v2/project_sessions/{}/project_sessions_skills/{}".format(project_session_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Project_sessions_rulesParams_project_sessions_rules(self, project_sessions_rule_id, **kwargs):
-        extension = "/v2/project_sessions_rules/{}/params_project_sessions_rules".format(project_sessions_rule_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsRetry(self, id, **kwargs):
-        extension = "/v2/projects/{}/retry".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsTags(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/tags".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsUsers(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/users".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsTeams(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/teams".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsExams(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/exams".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsSlots(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/slots".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsScales(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/scales".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsProjects(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/projects".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsRegister(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/register".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsScale_teams(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/scale_teams".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsAttachments(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/attachments".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsProjects_users(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/projects_users".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ProjectsProject_sessions(self, project_id, **kwargs):
-        extension = "/v2/projects/{}/project_sessions".format(project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Projects_usersRetry(self, id, **kwargs):
-        extension = "/v2/projects_users/{}/retry".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Projects_usersCompile(self, id, **kwargs):
-        extension = "/v2/projects_users/{}/compile".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Projects_usersExperiences(self, projects_user_id, **kwargs):
-        extension = "/v2/projects_users/{}/experiences".format(projects_user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def QuestsUsers(self, quest_id, **kwargs):
-        extension = "/v2/quests/{}/users".format(quest_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def QuestsQuests_users(self, quest_id, **kwargs):
-        extension = "/v2/quests/{}/quests_users".format(quest_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def ReportsPatronages_reports(self, report_id, **kwargs):
-        extension = "/v2/reports/{}/patronages_reports".format(report_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def RolesRoles_entities(self, role_id, **kwargs):
-        extension = "/v2/roles/{}/roles_entities".format(role_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Scale_teamsMultiple_create(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/scale_teamsmultiple_create.html"
-        """
-        extension = "/v2/scale_teams/multiple_create"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Scale_teamsFeedbacks(self, scale_team_id, **kwargs):
-        extension = "/v2/scale_teams/{}/feedbacks".format(scale_team_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Scale_teamsFeedbacks(self, scale_team_id, id, **kwargs):
-        extension = "/v2/scale_teams/{}/feedbacks/{}".format(scale_team_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def SkillsExperiences(self, skill_id, **kwargs):
-        extension = "/v2/skills/{}/experiences".format(skill_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def SkillsProject_sessions_skills(self, skill_id, **kwargs):
-        extension = "/v2/skills/{}/project_sessions_skills".format(skill_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Staff(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/staff.html"
-        """
-        extension = "/v2/staff"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TagsNotions(self, tag_id, **kwargs):
-        extension = "/v2/tags/{}/notions".format(tag_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TagsTags_users(self, tag_id, **kwargs):
-        extension = "/v2/tags/{}/tags_users".format(tag_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TeamsUsers(self, team_id, **kwargs):
-        extension = "/v2/teams/{}/users".format(team_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TeamsTeams_users(self, team_id, **kwargs):
-        extension = "/v2/teams/{}/teams_users".format(team_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TeamsReset_team_uploads(self, id, **kwargs):
-        extension = "/v2/teams/{}/reset_team_uploads".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TeamsTeams_uploads(self, team_id, **kwargs):
-        extension = "/v2/teams/{}/teams_uploads".format(team_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def Teams_uploadsMultiple_create(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/teams_uploadsmultiple_create.html"
-        """
-        extension = "/v2/teams_uploads/multiple_create"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TitlesUsers(self, title_id, **kwargs):
-        extension = "/v2/titles/{}/users".format(title_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TitlesAchievements(self, title_id, **kwargs):
-        extension = "/v2/titles/{}/achievements".format(title_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TitlesTitles_users(self, title_id, **kwargs):
-        extension = "/v2/titles/{}/titles_users".format(title_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def TranslationsUpload(self, **kwargs):
-        """
-        More details: "https://api.intra.42.fr/apidoc/2.0/translationsupload.html"
-        """
-        extension = "/v2/translations/upload"
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersExam(self, id, **kwargs):
-        extension = "/v2/users/{}/exam".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersApps(self, user_id, **kwargs):
-        extension = "/v2/users/{}/apps".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersTags(self, user_id, **kwargs):
-        extension = "/v2/users/{}/tags".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersNotes(self, user_id, **kwargs):
-        extension = "/v2/users/{}/notes".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersSlots(self, user_id, **kwargs):
-        extension = "/v2/users/{}/slots".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersRoles(self, user_id, **kwargs):
-        extension = "/v2/users/{}/roles".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersTeams(self, user_id, **kwargs):
-        extension = "/v2/users/{}/teams".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersExams(self, user_id, **kwargs):
-        extension = "/v2/users/{}/exams".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersTitles(self, user_id, **kwargs):
-        extension = "/v2/users/{}/titles".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersCloses(self, user_id, **kwargs):
-        extension = "/v2/users/{}/closes".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersScales(self, user_id, **kwargs):
-        extension = "/v2/users/{}/scales".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersEvents(self, user_id, **kwargs):
-        extension = "/v2/users/{}/events".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersGroups(self, user_id, **kwargs):
-        extension = "/v2/users/{}/groups".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersQuests(self, user_id, **kwargs):
-        extension = "/v2/users/{}/quests".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersUnfreeze(self, user_id, **kwargs):
-        extension = "/v2/users/{}/unfreeze".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersMailings(self, user_id, **kwargs):
-        extension = "/v2/users/{}/mailings".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersLocations(self, user_id, **kwargs):
-        extension = "/v2/users/{}/locations".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersPatronages(self, user_id, **kwargs):
-        extension = "/v2/users/{}/patronages".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersLocations_stats(self, id, **kwargs):
-        extension = "/v2/users/{}/locations_stats".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersTags_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/tags_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersCoalitions(self, user_id, **kwargs):
-        extension = "/v2/users/{}/coalitions".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersExperiences(self, user_id, **kwargs):
-        extension = "/v2/users/{}/experiences".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersTeams_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/teams_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersScale_teams(self, user_id, **kwargs):
-        extension = "/v2/users/{}/scale_teams".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersInternships(self, user_id, **kwargs):
-        extension = "/v2/users/{}/internships".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersTitles_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/titles_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersGroups_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/groups_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersEvents_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/events_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersQuests_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/quests_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersCursus_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/cursus_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersTransactions(self, user_id, **kwargs):
-        extension = "/v2/users/{}/transactions".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersCampus_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/campus_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersGitlab_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/gitlab_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersOffers_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/offers_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersFree_past_agu(self, user_id, **kwargs):
-        extension = "/v2/users/{}/free_past_agu".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersLocations(self, user_id, id, **kwargs):
-        extension = "/v2/users/{}/locations/{}".format(user_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersProjects_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/projects_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersInternships(self, user_id, id, **kwargs):
-        extension = "/v2/users/{}/internships/{}".format(user_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersLanguages_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/languages_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersExpertises_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/expertises_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersCorrection_pointsAdd(self, id, **kwargs):
-        extension = "/v2/users/{}/correction_points/add".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersUser_candidature(self, user_id, **kwargs):
-        extension = "/v2/users/{}/user_candidature".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersCoalitions_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/coalitions_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersCertificates_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/certificates_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersPatronages_reports(self, user_id, **kwargs):
-        extension = "/v2/users/{}/patronages_reports".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersCorrection_pointsRemove(self, id, **kwargs):
-        extension = "/v2/users/{}/correction_points/remove".format(id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersLanguages_users(self, user_id, id, **kwargs):
-        extension = "/v2/users/{}/languages_users/{}".format(user_id, id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersAnti_grav_units_users(self, user_id, **kwargs):
-        extension = "/v2/users/{}/anti_grav_units_users".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersScale_teamsAs_corrector(self, user_id, **kwargs):
-        extension = "/v2/users/{}/scale_teams/as_corrector".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersScale_teamsAs_corrected(self, user_id, **kwargs):
-        extension = "/v2/users/{}/scale_teams/as_corrected".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersProjectsTeams(self, user_id, project_id, **kwargs):
-        extension = "/v2/users/{}/projects/{}/teams".format(user_id, project_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
-    def UsersCorrection_point_historics(self, user_id, **kwargs):
-        extension = "/v2/users/{}/correction_point_historics".format(user_id)
-        return HttpMethod(extension, self.session, **kwargs)
-        
\ No newline at end of file
+        return AsyncHttpMethod(endpoint, self.session, **kwargs)
+
+    async def Close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.Close()
+
+ENDPOINTS = {
+    "Accreditations": ["/v2/accreditations", "/v2/accreditations/{id}"],
+    "AccreditationsUsers": ["/v2/accreditations/{accreditation_id}/users"],
+    "Achievements": ["/v2/achievements", "/v2/achievements/{id}"],
+    "AchievementsAchievements_users": ["/v2/achievements/{achievement_id}/achievements_users"],
+    "AchievementsUsers": ["/v2/achievements/{achievement_id}/users"],
+    "Achievements_users": ["/v2/achievements_users", "/v2/achievements_users/{id}"],
+    "Announcements": ["/v2/announcements", "/v2/announcements/{id}"],
+    "Anti_grav_units": ["/v2/anti_grav_units", "/v2/anti_grav_units/{id}"],
+    "Anti_grav_units_users": ["/v2/anti_grav_units_users", "/v2/anti_grav_units_users/{id}"],
+    "Apps": ["/v2/apps", "/v2/apps/{id}"],
+    "Attachments": ["/v2/attachments", "/v2/attachments/{id}"],
+    "Balances": ["/v2/balances", "/v2/balances/{id}"],
+    "Bloc_deadlines": ["/v2/bloc_deadlines", "/v2/bloc_deadlines/{id}"],
+    "Blocs": ["/v2/blocs", "/v2/blocs/{id}"],
+    "BlocsBloc_deadlines": ["/v2/blocs/{bloc_id}/bloc_deadlines"],
+    "BlocsCoalitions": ["/v2/blocs/{bloc_id}/coalitions"],
+    "BlocsScores": ["/v2/blocs/{bloc_id}/scores", "/v2/blocs/{bloc_id}/scores/{id}"],
+    "BlocsSquads": ["/v2/blocs/{bloc_id}/squads", "/v2/blocs/{bloc_id}/squads/{id}"],
+    "BlocsSquads_users": ["/v2/blocs/{bloc_id}/squads_users", "/v2/blocs/{bloc_id}/squads_users/{id}"],
+    "Campus": ["/v2/campus", "/v2/campus/{id}"],
+    "CampusAchievements": ["/v2/campus/{campus_id}/achievements"],
+    "CampusAnti_grav_units_users": ["/v2/campus/{campus_id}/anti_grav_units_users"],
+    "CampusBroadcasts": ["/v2/campus/{campus_id}/broadcasts"],
+    "CampusCursusEvents": ["/v2/campus/{campus_id}/cursus/{cursus_id}/events"],
+    "CampusCursusExams": ["/v2/campus/{campus_id}/cursus/{cursus_id}/exams"],
+    "CampusEvents": ["/v2/campus/{campus_id}/events"],
+    "CampusExams": ["/v2/campus/{campus_id}/exams"],
+    "CampusJournal": ["/v2/campus/journal"],
+    "CampusLocations": ["/v2/campus/{campus_id}/locations"],
+    "CampusLocationsEnd_all": ["/v2/campus/{campus_id}/locations/end_all"],
+    "CampusNotes": ["/v2/campus/{campus_id}/notes"],
+    "CampusProducts": ["/v2/campus/{campus_id}/products", "/v2/campus/{campus_id}/products/{id}"],
+    "CampusProductsCommands": ["/v2/campus/{campus_id}/products/{product_id}/commands"],
+    "CampusQuests": ["/v2/campus/{campus_id}/quests"],
+    "CampusStats": ["/v2/campus/{campus_id}/stats"],
+    "CampusTags_users": ["/v2/campus/{campus_id}/tags_users"],
+    "CampusUsers": ["/v2/campus/{campus_id}/users"],
+    "Campus_users": ["/v2/campus_users", "/v2/campus_users/{id}"],
+    "Certificates": ["/v2/certificates", "/v2/certificates/{id}"],
+    "CertificatesCertificates_users": ["/v2/certificates/{certificate_id}/certificates_users"],
+    "Certificates_users": ["/v2/certificates_users", "/v2/certificates_users/{id}"],
+    "Closes": ["/v2/closes", "/v2/closes/{id}"],
+    "ClosesClose": ["/v2/closes/{id}/close"],
+    "ClosesCommunity_services": ["/v2/closes/{close_id}/community_services"],
+    "ClosesUnclose": ["/v2/closes/{id}/unclose"],
+    "Coalitions": ["/v2/coalitions", "/v2/coalitions/{id}"],
+    "CoalitionsCoalitions_users": ["/v2/coalitions/{coalition_id}/coalitions_users"],
+    "CoalitionsScores": ["/v2/coalitions/{coalition_id}/scores", "/v2/coalitions/{coalition_id}/scores/{id}"],
+    "CoalitionsUsers": ["/v2/coalitions/{coalition_id}/users"],
+    "Coalitions_users": ["/v2/coalitions_users", "/v2/coalitions_users/{id}"],
+    "Coalitions_usersScores": ["/v2/coalitions_users/{coalitions_user_id}/scores", "/v2/coalitions_users/{coalitions_user_id}/scores/{id}"],
+    "Community_services": ["/v2/community_services", "/v2/community_services/{id}"],
+    "Community_servicesInvalidate": ["/v2/community_services/{id}/invalidate"],
+    "Community_servicesValidate": ["/v2/community_services/{id}/validate"],
+    "Companies": ["/v2/companies", "/v2/companies/{id}"],
+    "CompaniesInternships_users": ["/v2/companies/{company_id}/internships_users"],
+    "CompaniesSubscribed_users": ["/v2/companies/{company_id}/subscribed_users"],
+    "Cursus": ["/v2/cursus", "/v2/cursus/{id}"],
+    "CursusAchievements": ["/v2/cursus/{cursus_id}/achievements"],
+    "CursusAnnouncements": ["/v2/cursus/{cursus_id}/announcements"],
+    "CursusCursus_users": ["/v2/cursus/{cursus_id}/cursus_users"],
+    "CursusEvents": ["/v2/cursus/{cursus_id}/events"],
+    "CursusExams": ["/v2/cursus/{cursus_id}/exams"],
+    "CursusLevels": ["/v2/cursus/{cursus_id}/levels"],
+    "CursusNotions": ["/v2/cursus/{cursus_id}/notions"],
+    "CursusProjects": ["/v2/cursus/{cursus_id}/projects"],
+    "CursusQuests": ["/v2/cursus/{cursus_id}/quests"],
+    "CursusSkills": ["/v2/cursus/{cursus_id}/skills"],
+    "CursusTags": ["/v2/cursus/{cursus_id}/tags"],
+    "CursusTags_users": ["/v2/cursus/{cursus_id}/tags_users"],
+    "CursusTeams": ["/v2/cursus/{cursus_id}/teams"],
+    "CursusUsers": ["/v2/cursus/{cursus_id}/users"],
+    "Cursus_users": ["/v2/cursus_users", "/v2/cursus_users/{id}"],
+    "Dashes": ["/v2/dashes", "/v2/dashes/{id}"],
+    "DashesDashes_users": ["/v2/dashes/{dash_id}/dashes_users"],
+    "DashesUsers": ["/v2/dashes/{dash_id}/users"],
+    "Dashes_users": ["/v2/dashes_users", "/v2/dashes_users/{id}"],
+    "Endpoints": ["/v2/endpoints", "/v2/endpoints/{id}"],
+    "Evaluations": ["/v2/evaluations", "/v2/evaluations/{id}"],
+    "Events": ["/v2/events", "/v2/events/{id}"],
+    "EventsEvents_users": ["/v2/events/{event_id}/events_users"],
+    "EventsFeedbacks": ["/v2/events/{event_id}/feedbacks", "/v2/events/{event_id}/feedbacks/{id}"],
+    "EventsUsers": ["/v2/events/{event_id}/users"],
+    "EventsWaitlist": ["/v2/events/{event_id}/waitlist"],
+    "Events_users": ["/v2/events_users", "/v2/events_users/{id}"],
+    "Exams": ["/v2/exams", "/v2/exams/{id}"],
+    "ExamsExams_users": ["/v2/exams/{exam_id}/exams_users", "/v2/exams/{exam_id}/exams_users/{id}"],
+    "ExamsWaitlist": ["/v2/exams/{exam_id}/waitlist"],
+    "Experiences": ["/v2/experiences", "/v2/experiences/{id}"],
+    "Expertises": ["/v2/expertises", "/v2/expertises/{id}"],
+    "ExpertisesExpertises_users": ["/v2/expertises/{expertise_id}/expertises_users"],
+    "ExpertisesUsers": ["/v2/expertises/{expertise_id}/users"],
+    "Expertises_users": ["/v2/expertises_users", "/v2/expertises_users/{id}"],
+    "Feedbacks": ["/v2/feedbacks", "/v2/feedbacks/{id}"],
+    "Flags": ["/v2/flags"],
+    "Flash_users": ["/v2/flash_users", "/v2/flash_users/{id}"],
+    "Flashes": ["/v2/flashes", "/v2/flashes/{id}"],
+    "FlashesFlash_users": ["/v2/flashes/{flash_id}/flash_users", "/v2/flashes/{flash_id}/flash_users/{id}"],
+    "Groups": ["/v2/groups", "/v2/groups/{id}"],
+    "GroupsGroups_users": ["/v2/groups/{group_id}/groups_users"],
+    "GroupsUsers": ["/v2/groups/{group_id}/users"],
+    "Groups_users": ["/v2/groups_users", "/v2/groups_users/{id}"],
+    "Internships": ["/v2/internships", "/v2/internships/{id}"],
+    "IssuesTags": ["/v2/issues/{issue_id}/tags"],
+    "Languages": ["/v2/languages", "/v2/languages/{id}"],
+    "Languages_users": ["/v2/languages_users", "/v2/languages_users/{id}"],
+    "Levels": ["/v2/levels"],
+    "Locations": ["/v2/locations", "/v2/locations/{id}"],
+    "Mailings": ["/v2/mailings", "/v2/mailings/{id}"],
+    "Me": ["/v2/me"],
+    "MeProjects": ["/v2/me/projects"],
+    "MeScale_teams": ["/v2/me/scale_teams"],
+    "MeScale_teamsAs_corrected": ["/v2/me/scale_teams/as_corrected"],
+    "MeScale_teamsAs_corrector": ["/v2/me/scale_teams/as_corrector"],
+    "MeSlots": ["/v2/me/slots"],
+    "MeTeams": ["/v2/me/teams"],
+    "Notes": ["/v2/notes", "/v2/notes/{id}"],
+    "Notions": ["/v2/notions", "/v2/notions/{id}"],
+    "NotionsSubnotions": ["/v2/notions/{notion_id}/subnotions"],
+    "NotionsTags": ["/v2/notions/{notion_id}/tags"],
+    "Offers": ["/v2/offers", "/v2/offers/{id}"],
+    "OffersOffers_users": ["/v2/offers/{offer_id}/offers_users"],
+    "Offers_users": ["/v2/offers_users", "/v2/offers_users/{id}"],
+    "Params_project_sessions_rules": ["/v2/params_project_sessions_rules", "/v2/params_project_sessions_rules/{id}"],
+    "Partnerships": ["/v2/partnerships", "/v2/partnerships/{id}"],
+    "PartnershipsPartnerships_users": ["/v2/partnerships/{partnership_id}/partnerships_users"],
+    "PartnershipsUsers": ["/v2/partnerships/{partnership_id}/users"],
+    "Partnerships_users": ["/v2/partnerships_users", "/v2/partnerships_users/{id}"],
+    "Partnerships_usersExperiences": ["/v2/partnerships_users/{partnerships_user_id}/experiences"],
+    "Patronages": ["/v2/patronages", "/v2/patronages/{id}"],
+    "PatronagesPatronages_reports": ["/v2/patronages/{patronage_id}/patronages_reports"],
+    "Patronages_reports": ["/v2/patronages_reports", "/v2/patronages_reports/{id}"],
+    "Pools": ["/v2/pools", "/v2/pools/{id}"],
+    "PoolsBalances": ["/v2/pools/{pool_id}/balances", "/v2/pools/{pool_id}/balances/{id}"],
+    "PoolsPointsAdd": ["/v2/pools/{id}/points/add"],
+    "PoolsPointsRemove": ["/v2/pools/{id}/points/remove"],
+    "Products": ["/v2/products", "/v2/products/{id}"],
+    "ProductsCommands": ["/v2/products/{product_id}/commands"],
+    "Project_data": ["/v2/project_data", "/v2/project_data/{id}"],
+    "Project_sessions": ["/v2/project_sessions", "/v2/project_sessions/{id}"],
+    "Project_sessionsAttachments": ["/v2/project_sessions/{project_session_id}/attachments", "/v2/project_sessions/{project_session_id}/attachments/{id}"],
+    "Project_sessionsProject_data": ["/v2/project_sessions/{project_session_id}/project_data"],
+    "Project_sessionsProject_sessions_rules": ["/v2/project_sessions/{project_session_id}/project_sessions_rules"],
+    "Project_sessionsProject_sessions_skills": ["/v2/project_sessions/{project_session_id}/project_sessions_skills", "/v2/project_sessions/{project_session_id}/project_sessions_skills/{id}"],
+    "Project_sessionsRules": ["/v2/project_sessions/{project_session_id}/rules"],
+    "Project_sessionsScale_teams": ["/v2/project_sessions/{project_session_id}/scale_teams", "/v2/project_sessions/{project_session_id}/scale_teams/{id}"],
+    "Project_sessionsScales": ["/v2/project_sessions/{project_session_id}/scales"],
+    "Project_sessionsTeams": ["/v2/project_sessions/{project_session_id}/teams"],
+    "Project_sessions_rules": ["/v2/project_sessions_rules", "/v2/project_sessions_rules/{id}"],
+    "Project_sessions_rulesParams_project_sessions_rules": ["/v2/project_sessions_rules/{project_sessions_rule_id}/params_project_sessions_rules"],
+    "Project_sessions_skills": ["/v2/project_sessions_skills", "/v2/project_sessions_skills/{id}"],
+    "Projects": ["/v2/projects", "/v2/projects/{id}"],
+    "ProjectsAttachments": ["/v2/projects/{project_id}/attachments"],
+    "ProjectsExams": ["/v2/projects/{project_id}/exams"],
+    "ProjectsProject_sessions": ["/v2/projects/{project_id}/project_sessions"],
+    "ProjectsProjects": ["/v2/projects/{project_id}/projects"],
+    "ProjectsProjects_users": ["/v2/projects/{project_id}/projects_users"],
+    "ProjectsRegister": ["/v2/projects/{project_id}/register"],
+    "ProjectsRetry": ["/v2/projects/{id}/retry"],
+    "ProjectsScale_teams": ["/v2/projects/{project_id}/scale_teams"],
+    "ProjectsScales": ["/v2/projects/{project_id}/scales"],
+    "ProjectsSlots": ["/v2/projects/{project_id}/slots"],
+    "ProjectsTags": ["/v2/projects/{project_id}/tags"],
+    "ProjectsTeams": ["/v2/projects/{project_id}/teams"],
+    "ProjectsUsers": ["/v2/projects/{project_id}/users"],
+    "Projects_users": ["/v2/projects_users", "/v2/projects_users/{id}"],
+    "Projects_usersCompile": ["/v2/projects_users/{id}/compile"],
+    "Projects_usersExperiences": ["/v2/projects_users/{projects_user_id}/experiences"],
+    "Projects_usersRetry": ["/v2/projects_users/{id}/retry"],
+    "Quests": ["/v2/quests", "/v2/quests/{id}"],
+    "QuestsQuests_users": ["/v2/quests/{quest_id}/quests_users"],
+    "QuestsUsers": ["/v2/quests/{quest_id}/users"],
+    "Quests_users": ["/v2/quests_users", "/v2/quests_users/{id}"],
+    "ReportsPatronages_reports": ["/v2/reports/{report_id}/patronages_reports"],
+    "Roles": ["/v2/roles", "/v2/roles/{id}"],
+    "RolesRoles_entities": ["/v2/roles/{role_id}/roles_entities"],
+    "Roles_entities": ["/v2/roles_entities", "/v2/roles_entities/{id}"],
+    "Rules": ["/v2/rules", "/v2/rules/{id}"],
+    "Scale_teams": ["/v2/scale_teams", "/v2/scale_teams/{id}"],
+    "Scale_teamsFeedbacks": ["/v2/scale_teams/{scale_team_id}/feedbacks", "/v2/scale_teams/{scale_team_id}/feedbacks/{id}"],
+    "Scale_teamsMultiple_create": ["/v2/scale_teams/multiple_create"],
+    "Scales": ["/v2/scales", "/v2/scales/{id}"],
+    "Scores": ["/v2/scores", "/v2/scores/{id}"],
+    "Skills": ["/v2/skills", "/v2/skills/{id}"],
+    "SkillsExperiences": ["/v2/skills/{skill_id}/experiences"],
+    "SkillsProject_sessions_skills": ["/v2/skills/{skill_id}/project_sessions_skills"],
+    "Slots": ["/v2/slots", "/v2/slots/{id}"],
+    "Staff": ["/v2/staff"],
+    "Subnotions": ["/v2/subnotions", "/v2/subnotions/{id}"],
+    "Tags": ["/v2/tags", "/v2/tags/{id}"],
+    "TagsNotions": ["/v2/tags/{tag_id}/notions"],
+    "TagsTags_users": ["/v2/tags/{tag_id}/tags_users"],
+    "Tags_users": ["/v2/tags_users", "/v2/tags_users/{id}"],
+    "Teams": ["/v2/teams", "/v2/teams/{id}"],
+    "TeamsReset_team_uploads": ["/v2/teams/{id}/reset_team_uploads"],
+    "TeamsTeams_uploads": ["/v2/teams/{team_id}/teams_uploads"],
+    "TeamsTeams_users": ["/v2/teams/{team_id}/teams_users"],
+    "TeamsUsers": ["/v2/teams/{team_id}/users"],
+    "Teams_uploads": ["/v2/teams_uploads", "/v2/teams_uploads/{id}"],
+    "Teams_uploadsMultiple_create": ["/v2/teams_uploads/multiple_create"],
+    "Teams_users": ["/v2/teams_users", "/v2/teams_users/{id}"],
+    "Titles": ["/v2/titles", "/v2/titles/{id}"],
+    "TitlesAchievements": ["/v2/titles/{title_id}/achievements"],
+    "TitlesTitles_users": ["/v2/titles/{title_id}/titles_users"],
+    "TitlesUsers": ["/v2/titles/{title_id}/users"],
+    "Titles_users": ["/v2/titles_users", "/v2/titles_users/{id}"],
+    "Transactions": ["/v2/transactions", "/v2/transactions/{id}"],
+    "Translations": ["/v2/translations", "/v2/translations/{id}"],
+    "TranslationsUpload": ["/v2/translations/upload"],
+    "User_candidatures": ["/v2/user_candidatures", "/v2/user_candidatures/{id}"],
+    "Users": ["/v2/users", "/v2/users/{id}"],
+    "UsersAnti_grav_units_users": ["/v2/users/{user_id}/anti_grav_units_users"],
+    "UsersApps": ["/v2/users/{user_id}/apps"],
+    "UsersCampus_users": ["/v2/users/{user_id}/campus_users"],
+    "UsersCertificates_users": ["/v2/users/{user_id}/certificates_users"],
+    "UsersCloses": ["/v2/users/{user_id}/closes"],
+    "UsersCoalitions": ["/v2/users/{user_id}/coalitions"],
+    "UsersCoalitions_users": ["/v2/users/{user_id}/coalitions_users"],
+    "UsersCorrection_point_historics": ["/v2/users/{user_id}/correction_point_historics"],
+    "UsersCorrection_pointsAdd": ["/v2/users/{id}/correction_points/add"],
+    "UsersCorrection_pointsRemove": ["/v2/users/{id}/correction_points/remove"],
+    "UsersCursus_users": ["/v2/users/{user_id}/cursus_users"],
+    "UsersEvents": ["/v2/users/{user_id}/events"],
+    "UsersEvents_users": ["/v2/users/{user_id}/events_users"],
+    "UsersExam": ["/v2/users/{id}/exam"],
+    "UsersExams": ["/v2/users/{user_id}/exams"],
+    "UsersExperiences": ["/v2/users/{user_id}/experiences"],
+    "UsersExpertises_users": ["/v2/users/{user_id}/expertises_users"],
+    "UsersFree_past_agu": ["/v2/users/{user_id}/free_past_agu"],
+    "UsersGitlab_users": ["/v2/users/{user_id}/gitlab_users"],
+    "UsersGroups": ["/v2/users/{user_id}/groups"],
+    "UsersGroups_users": ["/v2/users/{user_id}/groups_users"],
+    "UsersInternships": ["/v2/users/{user_id}/internships", "/v2/users/{user_id}/internships/{id}"],
+    "UsersLanguages_users": ["/v2/users/{user_id}/languages_users", "/v2/users/{user_id}/languages_users/{id}"],
+    "UsersLocations": ["/v2/users/{user_id}/locations", "/v2/users/{user_id}/locations/{id}"],
+    "UsersLocations_stats": ["/v2/users/{id}/locations_stats"],
+    "UsersMailings": ["/v2/users/{user_id}/mailings"],
+    "UsersNotes": ["/v2/users/{user_id}/notes"],
+    "UsersOffers_users": ["/v2/users/{user_id}/offers_users"],
+    "UsersPatronages": ["/v2/users/{user_id}/patronages"],
+    "UsersPatronages_reports": ["/v2/users/{user_id}/patronages_reports"],
+    "UsersProjectsTeams": ["/v2/users/{user_id}/projects/{project_id}/teams"],
+    "UsersProjects_users": ["/v2/users/{user_id}/projects_users"],
+    "UsersQuests": ["/v2/users/{user_id}/quests"],
+    "UsersQuests_users": ["/v2/users/{user_id}/quests_users"],
+    "UsersRoles": ["/v2/users/{user_id}/roles"],
+    "UsersScale_teams": ["/v2/users/{user_id}/scale_teams"],
+    "UsersScale_teamsAs_corrected": ["/v2/users/{user_id}/scale_teams/as_corrected"],
+    "UsersScale_teamsAs_corrector": ["/v2/users/{user_id}/scale_teams/as_corrector"],
+    "UsersScales": ["/v2/users/{user_id}/scales"],
+    "UsersSlots": ["/v2/users/{user_id}/slots"],
+    "UsersTags": ["/v2/users/{user_id}/tags"],
+    "UsersTags_users": ["/v2/users/{user_id}/tags_users"],
+    "UsersTeams": ["/v2/users/{user_id}/teams"],
+    "UsersTeams_users": ["/v2/users/{user_id}/teams_users"],
+    "UsersTitles": ["/v2/users/{user_id}/titles"],
+    "UsersTitles_users": ["/v2/users/{user_id}/titles_users"],
+    "UsersTransactions": ["/v2/users/{user_id}/transactions"],
+    "UsersUnfreeze": ["/v2/users/{user_id}/unfreeze"],
+    "UsersUser_candidature": ["/v2/users/{user_id}/user_candidature"],
+    "Waitlists": ["/v2/waitlists", "/v2/waitlists/{id}"],
+}
+
+ENDPOINT_METHODS = {
+}
@@ -1,3 +1,4 @@
 name = "FtApi"
 
-from .FtApi import FtApi
+from .FtApi import FtApi, AsyncFtApi, FtApiPool, HttpMethod, RateLimiter, FileRateLimiter, Scheduler, ConcurrencyController, RetryPolicy, TokenStore, MarkStore, PageResult, DeadlineExceeded
+from .FtApi import ResponseCache, CacheRule, MemoryStore, SqliteStore
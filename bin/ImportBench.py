@@ -0,0 +1,42 @@
+import subprocess
+import sys
+import os
+
+# Measure how long "import FtApi" takes in a fresh interpreter
+# and fail if it gets slower than the budget or pulls an optional module.
+#
+# usage: python3 bin/ImportBench.py [budget in seconds] [runs]
+
+HEAVY_MODULES = ["pygments"]
+
+CODE = """
+import sys, time
+start = time.perf_counter()
+import FtApi
+print(time.perf_counter() - start)
+print(",".join(name for name in {} if name in sys.modules))
+""".format(HEAVY_MODULES)
+
+def MeasureImport(root):
+    output = subprocess.run([sys.executable, "-c", CODE], cwd=root, check=True,
+            capture_output=True, text=True).stdout.splitlines()
+    return float(output[0]), output[1] if len(output) > 1 else ""
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    results = [MeasureImport(root) for _ in range(runs)]
+    timings = sorted(elapsed for elapsed, _ in results)
+    median = timings[len(timings) // 2]
+    loaded = {name for _, names in results for name in names.split(",") if name}
+    print("[+] import FtApi: median {:.1f}ms, min {:.1f}ms, max {:.1f}ms ({} runs)".format(
+        median * 1000, timings[0] * 1000, timings[-1] * 1000, runs))
+
+    if loaded:
+        print("[-] optional modules imported at load time:", ", ".join(sorted(loaded)))
+        exit(1)
+    if median > budget:
+        print("[-] import is slower than the budget of {:.1f}ms".format(budget * 1000))
+        exit(1)
@@ -4,7 +4,6 @@ requires = [
     'certifi>=2019.6.16',
     'chardet>=3.0.4',
     'idna>=2.8',
-    'Pygments>=2.4.2',
     'requests>=2.22.0',
     'urllib3>=1.26.5'
 ]
@@ -19,4 +18,5 @@ setup(
     description='Class for manipulating 42 Api',
     long_description=open('README.md').read(),
     install_requires=requires,
+    extras_require={'color': ['Pygments>=2.4.2'], 'async': ['aiohttp>=3.8']},
     packages=find_packages())